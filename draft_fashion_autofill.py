@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
-import os, sys, html, json, csv, re, traceback, requests, base64
+import os, sys, html, json, csv, re, traceback, base64, time, threading, hashlib, zipfile, atexit, functools, contextlib, collections, socket, uuid
+_T0 = time.perf_counter()
+from collections import namedtuple
 from urllib.parse import urlparse, urljoin
 from datetime import datetime
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
+# requests, bs4/lxml, cv2, rembg: importati alla prima fase che li usa (_lazy_import)
 
 VERSION = "2025-10-10-v8-gallery-single-source+face-crop+rename-jpg+desc-structure"
 load_dotenv()
@@ -29,15 +31,28 @@ TRUSTED_RETAILER_DOMAINS = [d.strip().lower() for d in os.getenv(
 
 DOMAINS_BLACKLIST = ["ebay.","aliexpress.","pinterest.","facebook.","tumblr.","wordpress.","blogspot.","vk.","tiktok.","twitter.","x.com","instagram."]
 SAFE_DOMAINS_HINTS= ["cdn","images","media","static","assets","content","img","cloudfront","akamaized"]
+HOST_CLASS_CACHE_SIZE = int(os.getenv("HOST_CLASS_CACHE_SIZE","4096"))
 WHITE_BG_KEYWORDS = ["white","bianco","packshot","studio","product","plain","ghost","sfondo-bianco"]
 
 WHITE_BG_BORDER_PCT  = float(os.getenv("WHITE_BG_BORDER_PCT","0.10"))
 WHITE_BG_THRESHOLD   = int(os.getenv("WHITE_BG_THRESHOLD","245"))
 WHITE_BG_MIN_RATIO   = float(os.getenv("WHITE_BG_MIN_RATIO","0.88"))
 IMAGE_MIN_SIDE       = int(os.getenv("IMAGE_MIN_SIDE","800"))
+SRCSET_HEADROOM      = float(os.getenv("SRCSET_HEADROOM","0.25"))   # margine sopra IMAGE_MIN_SIDE nella scelta della variante
+SRCSET_MAX_ASPECT    = float(os.getenv("SRCSET_MAX_ASPECT","1.5"))  # larghezza/altezza ipotizzata: il descrittore w non dà l'altezza
 DOWNLOAD_TIMEOUT_SEC = int(os.getenv("DOWNLOAD_TIMEOUT_SEC","10"))
 MAX_DOWNLOAD_BYTES   = int(os.getenv("MAX_DOWNLOAD_BYTES","3500000"))
 CONTEXT_FETCH_MAX    = int(os.getenv("CONTEXT_FETCH_MAX","300000"))
+IMAGE_MEMORY_BUDGET_MB = int(os.getenv("IMAGE_MEMORY_BUDGET_MB","512"))
+IMAGE_WORKERS        = int(os.getenv("IMAGE_WORKERS","0"))   # 0 = fasi immagine nel processo principale
+
+# === Encoding output ===
+OUTPUT_FORMAT        = os.getenv("OUTPUT_FORMAT","jpeg").strip().lower()   # jpeg | webp
+OUTPUT_MAX_SIDE      = int(os.getenv("OUTPUT_MAX_SIDE","2048"))            # 0 = risoluzione originale
+OUTPUT_QUALITY       = int(os.getenv("OUTPUT_QUALITY","90"))
+OUTPUT_MIN_QUALITY   = int(os.getenv("OUTPUT_MIN_QUALITY","70"))
+OUTPUT_TARGET_BYTES  = int(os.getenv("OUTPUT_TARGET_BYTES","0"))           # 0 = nessun target
+OUTPUT_PROGRESSIVE   = os.getenv("OUTPUT_PROGRESSIVE","true").lower()=="true"
 
 # === Background handling ===
 ALLOW_COLORED_BG              = os.getenv("ALLOW_COLORED_BG","true").lower()=="true"
@@ -66,6 +81,19 @@ LIFESTYLE_HINT_WORDS        = [w.strip().lower() for w in os.getenv(
 NEGATIVE_KEYWORDS_IMG       = [w.strip().lower() for w in os.getenv("NEGATIVE_KEYWORDS_IMG","logo,icon,placeholder,packaging,graphic,sprite").split(",") if w.strip()]
 COLOR_OPTION_NAMES          = [s.strip().lower() for s in os.getenv("COLOR_OPTION_NAMES","Color,Colore,Colour,COLORE,COLOUR").split(",") if s.strip()]
 
+# === Verifica colore sui pixel (prima di volti/rembg) ===
+PIXEL_COLOR_GATE            = os.getenv("PIXEL_COLOR_GATE","true").lower()=="true"
+PIXEL_COLOR_MAX_DELTA_E     = float(os.getenv("PIXEL_COLOR_MAX_DELTA_E","20"))
+PIXEL_COLOR_MIN_SHARE       = float(os.getenv("PIXEL_COLOR_MIN_SHARE","0.15"))
+PIXEL_PROXY_SIDE            = int(os.getenv("PIXEL_PROXY_SIDE","96"))
+
+# === Catena filtri galleria ===
+IMAGE_HEADER_PROBE          = os.getenv("IMAGE_HEADER_PROBE","true").lower()=="true"   # dimensioni via Range prima del download
+IMAGE_PROBE_BYTES           = int(os.getenv("IMAGE_PROBE_BYTES","65536"))
+IMAGE_PROBE_MIN_REJECT_RATE = float(os.getenv("IMAGE_PROBE_MIN_REJECT_RATE","0.05"))  # sotto questa quota la sonda si salta
+FILTER_WARMUP               = int(os.getenv("FILTER_WARMUP","30"))        # campioni prima di usare i tempi misurati
+FILTER_STATS_PATH           = os.getenv("FILTER_STATS_PATH","filter_stats.json")   # "" = nessuno storico
+
 # === Face detection (solo foto senza volti o con crop) ===
 ENFORCE_FACE_DETECTION      = os.getenv("ENFORCE_FACE_DETECTION","true").lower()=="true"
 FACE_CASCADE_PATH           = os.getenv("FACE_CASCADE_PATH","./haarcascade_frontalface_default.xml")
@@ -85,8 +113,59 @@ STRICT_CODE_DESC_ONLY   = os.getenv("STRICT_CODE_DESC_ONLY","true").lower()=="tr
 SUPPLIER_CODE_OFFSET    = int(os.getenv("SUPPLIER_CODE_OFFSET","6"))
 SUPPLIER_CODE_REGEX     = os.getenv("SUPPLIER_CODE_REGEX","")
 
+# === Shopify throttling (REST leaky bucket + GraphQL cost) ===
+SHOPIFY_REST_BUCKET_SIZE    = int(os.getenv("SHOPIFY_REST_BUCKET_SIZE","40"))
+SHOPIFY_REST_LEAK_RATE      = float(os.getenv("SHOPIFY_REST_LEAK_RATE","2"))
+SHOPIFY_THROTTLE_MARGIN     = float(os.getenv("SHOPIFY_THROTTLE_MARGIN","0.10"))
+SHOPIFY_GQL_DEFAULT_COST    = float(os.getenv("SHOPIFY_GQL_DEFAULT_COST","50"))
+SHOPIFY_MAX_RETRIES         = int(os.getenv("SHOPIFY_MAX_RETRIES","6"))
+
+# === Scritture Shopify in batch (productUpdate + metafieldsSet aliasati) ===
+BATCH_SHOPIFY_WRITES        = os.getenv("BATCH_SHOPIFY_WRITES","true").lower()=="true"
+SHOPIFY_WRITE_BATCH_SIZE    = int(os.getenv("SHOPIFY_WRITE_BATCH_SIZE","20"))
+SHOPIFY_BATCH_MAX_COST      = float(os.getenv("SHOPIFY_BATCH_MAX_COST","400"))
+
+# === HTTP: live / record / replay ===
+HTTP_MODE                   = os.getenv("HTTP_MODE","live").strip().lower()   # live | record | replay
+HTTP_ARCHIVE_PATH           = os.getenv("HTTP_ARCHIVE_PATH","./http_archive.zip")
+HTTP_REPLAY_LATENCY         = float(os.getenv("HTTP_REPLAY_LATENCY","0"))     # 0 = nessuna, 1 = come registrato
+HTTP_POOL_SIZE              = int(os.getenv("HTTP_POOL_SIZE","16"))
+
+# === Scheduler per host (retailer) ===
+HOST_MAX_CONCURRENCY        = max(1, int(os.getenv("HOST_MAX_CONCURRENCY","2")))
+HOST_MIN_DELAY_SEC          = float(os.getenv("HOST_MIN_DELAY_SEC","0.5"))
+HOST_MAX_DELAY_SEC          = float(os.getenv("HOST_MAX_DELAY_SEC","30"))
+FETCH_CONCURRENCY           = max(1, int(os.getenv("FETCH_CONCURRENCY","4")))   # fetch in parallelo (pagine/immagini) per prodotto
+
+# === Deadline per prodotto / fase ===
+PRODUCT_DEADLINE_SEC        = float(os.getenv("PRODUCT_DEADLINE_SEC","180"))   # 0 = nessun limite
+STAGE_DEADLINES             = {k.strip(): float(v) for k, _, v in (x.partition(":") for x in os.getenv("STAGE_DEADLINES","").split(",")) if k.strip() and v.strip()}
+
+# === Daemon (webhook + coda locale) ===
+SERVE_HOST                  = os.getenv("SERVE_HOST","127.0.0.1")
+SERVE_PORT                  = int(os.getenv("SERVE_PORT","8787"))
+SHOPIFY_WEBHOOK_SECRET      = os.getenv("SHOPIFY_WEBHOOK_SECRET","")
+ALLOW_UNSIGNED_WEBHOOKS     = os.getenv("ALLOW_UNSIGNED_WEBHOOKS","false").lower()=="true"   # solo con SERVE_HOST loopback
+QUEUE_DB_PATH               = os.getenv("QUEUE_DB_PATH","./autofill_queue.sqlite")
+DAEMON_WORKERS              = max(1, int(os.getenv("DAEMON_WORKERS","2")))
+QUEUE_MAX_ATTEMPTS          = int(os.getenv("QUEUE_MAX_ATTEMPTS","3"))
+DAEMON_REPORT_PATH          = os.getenv("DAEMON_REPORT_PATH","./report_autofill_daemon.csv")
+
+# === Esecuzione shardata (più nodi, lease su tabella condivisa) ===
+SHARD_DB_PATH               = os.getenv("SHARD_DB_PATH","")   # SQLite su storage condiviso, obbligatorio con --shard
+SHARD_LEASE_SEC             = float(os.getenv("SHARD_LEASE_SEC","300"))
+SHARD_HEARTBEAT_SEC         = float(os.getenv("SHARD_HEARTBEAT_SEC","60"))
+NODE_ID                     = os.getenv("NODE_ID","") or f"{socket.gethostname()}:{os.getpid()}"
+
+# === Profilazione (opt-in, solo i prodotti selezionati) ===
+PROFILE_PRODUCTS            = os.getenv("PROFILE_PRODUCTS","").strip()   # id/gid/SKU separati da virgola, frazione (es. 0.05) o "all"
+                                                                             # .folded: solo thread prodotto; .pstats su Python 3.12+ anche gli altri thread (solo se nessun altro prodotto è in corso); process pool escluso
+PROFILE_SAMPLE_MS           = float(os.getenv("PROFILE_SAMPLE_MS","5"))   # intervallo del campionatore di stack
+PROFILE_DIR                 = os.getenv("PROFILE_DIR",".")                 # .pstats / .folded (accanto al report)
+
 DEBUG = os.getenv("DEBUG","false").lower()=="true"
 ADMIN_URL = f"https://{STORE}/admin/products/{{pid}}"
+RUN_TS = datetime.now().strftime("%Y%m%d_%H%M%S")   # etichetta del report di fine run
 
 ALLOWED_SKUS = [x.strip() for x in os.getenv("PRODUCT_SKUS","").split(",") if x.strip()]
 ALLOWED_EANS = [x.strip() for x in os.getenv("PRODUCT_EANS","").split(",") if x.strip()]
@@ -108,6 +187,57 @@ def domain(u):
     try: return urlparse(u or "").netloc.lower()
     except: return ""
 
+# === Import pigri e tempi di warm-up ===
+_WARMUP_TIMES = {}   # componente -> secondi (import pesanti, cascade, rembg, pool)
+_warmup_total_sec = 0.0   # solo i timer più esterni (i componenti annidati non si sommano due volte)
+_warmup_lock = threading.Lock()
+_warmup_local = threading.local()
+
+@contextlib.contextmanager
+def _warm_timer(name):
+    global _warmup_total_sec
+    depth = getattr(_warmup_local, "depth", 0); _warmup_local.depth = depth + 1
+    t = time.perf_counter()
+    try: yield
+    finally:
+        dt = time.perf_counter() - t; _warmup_local.depth = depth
+        with _warmup_lock:
+            _WARMUP_TIMES[name] = _WARMUP_TIMES.get(name, 0.0) + dt
+            if depth == 0: _warmup_total_sec += dt
+
+def _warmup_total():
+    with _warmup_lock: return _warmup_total_sec
+
+def _lazy_import(name):
+    # import alla prima richiesta, tempo contato nel warm-up
+    import importlib
+    if name in sys.modules: return importlib.import_module(name)
+    with _warm_timer(f"import:{name.split('.')[0]}"):
+        return importlib.import_module(name)
+
+# === Host classifier (blacklist / whitelist / retailer / hint) ===
+class HostClass(namedtuple("HostClass", "blacklisted brand_whitelisted trusted_retailer safe_hint")):
+    __slots__ = ()
+    @property
+    def trusted(self): return self.brand_whitelisted or self.trusted_retailer
+
+class _HostClassifier:
+    # stesse regole (pattern come sottostringa dell'host), lookup in set per lunghezza; cache per host
+    def __init__(self, blacklist, brand_whitelist, retailers, safe_hints, cache_size=4096):
+        self.sets = [frozenset(w for w in lst if w) for lst in (blacklist, brand_whitelist, retailers, safe_hints)]
+        self.lengths = sorted({len(w) for st in self.sets for w in st})
+        self.classify = functools.lru_cache(maxsize=cache_size)(self._classify)
+
+    def _classify(self, host):
+        host = (host or "").lower(); n = len(host)
+        subs = {host[i:i+L] for L in self.lengths if L <= n for i in range(n-L+1)}
+        return HostClass(*[not subs.isdisjoint(st) for st in self.sets])
+
+_HOST_CLASSIFIER = _HostClassifier(DOMAINS_BLACKLIST, BRAND_DOMAINS_WHITELIST, TRUSTED_RETAILER_DOMAINS, SAFE_DOMAINS_HINTS, HOST_CLASS_CACHE_SIZE)
+
+def classify_host(d) -> HostClass:
+    return _HOST_CLASSIFIER.classify((d or "").lower())
+
 def product_id_from_gid(gid:str)->int:
     return int(str(gid).split("/")[-1])
 
@@ -115,42 +245,480 @@ def _norm(s): return re.sub(r"[^a-z0-9]", "", (s or "").lower())
 def _brand_like(s): return _norm(s)
 def _bool_score(ok, w): return w if ok else 0.0
 
-def shopify_graphql(q, vars_=None):
+# === Deadline (budget di tempo per prodotto e per fase) ===
+class DeadlineExceeded(Exception):
+    pass
+
+class _Deadline:
+    # budget di tempo del prodotto corrente (thread-local); stage() misura e limita le fasi
+    def __init__(self, total_sec, stage_limits=None):
+        self.t0 = time.monotonic()
+        self.expires = self.t0 + total_sec if total_sec and total_sec > 0 else float("inf")
+        self.stage_limits = stage_limits or {}
+        self.stage_name = None; self.stage_expires = float("inf")
+        self.stage_times = {}; self.exhausted = []
+        self.profiler = None
+
+    @property
+    def exhausted_stage(self):
+        return ",".join(self.exhausted)
+
+    def _mark(self, name):
+        if name not in self.exhausted: self.exhausted.append(name)
+
+    def remaining(self):
+        return min(self.expires, self.stage_expires) - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            name = self.stage_name or "product"
+            self._mark(name)
+            raise DeadlineExceeded(name)
+
+    def clip(self, timeout):
+        self.check()
+        rem = self.remaining()
+        if timeout is None: return rem if rem != float("inf") else None
+        if isinstance(timeout, tuple): return tuple(min(t, rem) for t in timeout)
+        return min(timeout, rem)
+
+    def stage(self, name):
+        return _DeadlineStage(self, name)
+
+    def summary(self):
+        parts = [f"{k}={v:.1f}s" for k, v in self.stage_times.items()]
+        return " ".join(parts + [f"total={time.monotonic()-self.t0:.1f}s"])
+
+class _DeadlineStage:
+    # DeadlineExceeded interrompe solo la fase, il prodotto prosegue
+    def __init__(self, dl, name):
+        self.dl = dl; self.name = name
+
+    def __enter__(self):
+        dl = self.dl
+        self.prev = (dl.stage_name, dl.stage_expires); self.t = time.monotonic()
+        lim = dl.stage_limits.get(self.name)
+        dl.stage_name = self.name
+        dl.stage_expires = self.t + lim if lim and lim > 0 else float("inf")
+        if dl.profiler: dl.profiler.switch(self.name)
+        return dl
+
+    def __exit__(self, et, ev, tb):
+        dl = self.dl
+        dl.stage_times[self.name] = dl.stage_times.get(self.name, 0.0) + (time.monotonic() - self.t)
+        dl.stage_name, dl.stage_expires = self.prev
+        if dl.profiler: dl.profiler.switch(dl.stage_name or "main")
+        if et is not None and issubclass(et, DeadlineExceeded):
+            dl._mark(self.name)
+            return True
+        return False
+
+_deadline_local = threading.local()
+
+# === Profilazione per prodotto / fase (PROFILE_PRODUCTS) ===
+def _profile_fraction():
+    try: f = float(PROFILE_PRODUCTS)
+    except ValueError: return None
+    return f if 0 < f <= 1 else None
+
+_PROFILE_KEYS = {x.strip().lower() for x in PROFILE_PRODUCTS.split(",") if x.strip()}
+
+def _profile_selected(n):
+    # tutti, frazione stabile (hash del gid) o per id/gid/SKU
+    if not PROFILE_PRODUCTS: return False
+    if PROFILE_PRODUCTS.lower() == "all": return True
+    gid = str(n.get("id") or "")
+    frac = _profile_fraction()
+    if frac is not None: return int(hashlib.sha1(gid.encode()).hexdigest()[:8], 16) < frac * 0x100000000
+    keys = {gid.lower(), gid.rsplit("/",1)[-1]}
+    keys |= {safe_strip(safe_get(e,"node","sku")).lower() for e in safe_get(n,"variants","edges",default=[]) or []}
+    return bool(keys & _PROFILE_KEYS)
+
+_PROFILE_SEQ = [0]; _PROFILE_SEQ_LOCK = threading.Lock()
+_CPROFILE_PROCESS_WIDE = sys.version_info >= (3, 12)   # cProfile su sys.monitoring: registra tutti i thread
+
+class _ProductProfiler:
+    # cProfile per fase + campionatore del solo thread prodotto (.folded); su 3.12+ cProfile vede tutto il processo
+    _lock = threading.Lock(); _running = 0; _owner = None
+
+    @classmethod
+    def product_started(cls):
+        with cls._lock:
+            cls._running += 1
+            if cls._owner is not None: cls._owner.mixed = True   # il suo .pstats vedrebbe anche questo prodotto
+
+    @classmethod
+    def product_finished(cls):
+        with cls._lock: cls._running -= 1
+
+    def __init__(self):
+        self.tid = threading.get_ident()
+        self.stage = "main"; self.profiles = {}
+        self.samples = collections.Counter()
+        self._stop = threading.Event(); self._sampler = None
+        self.use_cprofile = True; self.mixed = False
+
+    def _enable(self, stage):
+        if not self.use_cprofile: return
+        import cProfile
+        p = self.profiles.get(stage)
+        if p is None: p = self.profiles[stage] = cProfile.Profile()
+        try: p.enable()
+        except ValueError as e:   # un altro profiler già attivo (Python 3.12+): resta il campionatore
+            self.use_cprofile = False; self.profiles.pop(stage, None)
+            if DEBUG: print(f"[PROFILE] cProfile non disponibile: {e}")
+
+    def _disable(self):
+        p = self.profiles.get(self.stage)
+        if self.use_cprofile and p is not None: p.disable()
+
+    def start(self):
+        if _CPROFILE_PROCESS_WIDE:
+            with _ProductProfiler._lock:
+                self.use_cprofile = _ProductProfiler._running <= 1 and _ProductProfiler._owner is None
+                if self.use_cprofile: _ProductProfiler._owner = self
+        self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+        self._sampler.start()
+        self._enable(self.stage)
+
+    def switch(self, stage):
+        self._disable()
+        self.stage = stage; self._enable(stage)
+
+    def stop(self):
+        self._disable()
+        with _ProductProfiler._lock:
+            if _ProductProfiler._owner is self: _ProductProfiler._owner = None
+        self._stop.set(); self._sampler.join(timeout=5)
+
+    def coverage(self):
+        if not self.use_cprofile or self.mixed: return "solo .folded del thread prodotto: altri prodotti in corso (cProfile 3.12+ è per processo)"
+        if _CPROFILE_PROCESS_WIDE: return ".pstats con tutti i thread del processo (prefetch inclusi), .folded solo thread prodotto; process pool escluso"
+        return "solo thread prodotto, esclusi prefetch e process pool"
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_SAMPLE_MS / 1000.0):
+            f = sys._current_frames().get(self.tid); stack = []
+            while f is not None:
+                co = f.f_code
+                stack.append(f"{co.co_name} ({os.path.basename(co.co_filename)}:{co.co_firstlineno})")
+                f = f.f_back
+            if stack: self.samples[(self.stage, ";".join(reversed(stack)))] += 1
+
+    def dump(self, label):
+        # timestamp e progressivo: in daemon/shard lo stesso prodotto può essere profilato più volte
+        import pstats
+        os.makedirs(PROFILE_DIR or ".", exist_ok=True)
+        with _PROFILE_SEQ_LOCK: _PROFILE_SEQ[0] += 1; seq = _PROFILE_SEQ[0]
+        base = os.path.join(PROFILE_DIR or ".", f"profile_{datetime.now():%Y%m%d_%H%M%S}_{label}_{seq}")
+        stats = []
+        for stage, p in (self.profiles.items() if self.use_cprofile and not self.mixed else ()):
+            try: st = pstats.Stats(p)
+            except TypeError: continue   # segmento senza dati
+            st.dump_stats(f"{base}_{stage}.pstats"); stats.append(st)
+        if stats:
+            total = stats[0]
+            for st in stats[1:]: total.add(st)
+            total.dump_stats(f"{base}_product.pstats")
+        by_stage = collections.defaultdict(list)
+        for (stage, stack), cnt in self.samples.items(): by_stage[stage].append((stack, cnt))
+        for stage, rows in list(by_stage.items()) + [("product", [(f"{st};{sk}", c) for (st, sk), c in self.samples.items()])]:
+            with open(f"{base}_{stage}.folded", "w", encoding="utf-8") as f:
+                for stack, cnt in sorted(rows): f.write(f"{stack} {cnt}\n")
+        return base
+
+def _current_deadline():
+    return getattr(_deadline_local, "current", None)
+
+def _deadline_check():
+    dl = _current_deadline()
+    if dl: dl.check()
+
+def _deadline_remaining():
+    dl = _current_deadline()
+    if not dl: return None
+    rem = dl.remaining()
+    return None if rem == float("inf") else max(0.0, rem)
+
+# === HTTP layer (live / record / replay) ===
+_REPLAY_KEEP_HEADERS = ["content-type","content-length","retry-after","x-shopify-shop-api-call-limit","location"]
+
+class _HeaderDict(dict):
+    def get(self, k, default=None): return super().get(str(k).lower(), default)
+    def __getitem__(self, k): return super().__getitem__(str(k).lower())
+    def __contains__(self, k): return super().__contains__(str(k).lower())
+
+class _ArchivedResponse:
+    # risposta dall'archivio: stessa interfaccia minima di requests.Response
+    def __init__(self, url, status_code, headers, content):
+        self.url = url; self.status_code = status_code
+        self.headers = _HeaderDict({str(k).lower(): v for k, v in (headers or {}).items()})
+        self.content = content or b""
+        self.encoding = "utf-8"
+    @property
+    def text(self): return self.content.decode(self.encoding, "ignore")
+    @property
+    def ok(self): return self.status_code < 400
+    def json(self): return json.loads(self.content.decode("utf-8"))
+    def iter_content(self, chunk_size=8192):
+        for i in range(0, len(self.content), chunk_size): yield self.content[i:i+chunk_size]
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise _lazy_import("requests").HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+    def close(self): pass
+    def __enter__(self): return self
+    def __exit__(self, *a): return False
+
+def _http_key(method, url, kw):
+    h = hashlib.sha1()
+    h.update(method.upper().encode()); h.update(b"\0"+(url or "").encode())
+    for part in ("params","json","data"):
+        if kw.get(part) is not None: h.update(b"\0"+json.dumps(kw[part], sort_keys=True, default=str).encode())
+    rng = (kw.get("headers") or {}).get("Range")
+    if rng: h.update(b"\0"+rng.encode())
+    return h.hexdigest()
+
+def _redact(url, params=None):
+    u = re.sub(r"(?i)([?&](?:key|token)=)[^&]+", r"\1***", url or "")
+    p = {k: ("***" if k.lower() in ("key","token") else v) for k, v in (params or {}).items()}
+    return u, p
+
+class _HttpArchive:
+    # zip: index.json (chiave richiesta -> risposte in ordine), body deduplicati per hash
+    def __init__(self, path, mode):
+        self._lock = threading.Lock()
+        self.path = path; self.mode = mode
+        self.index = {}; self.cursor = {}; self.bodies = set()
+        if mode == "replay":
+            self.zf = zipfile.ZipFile(path, "r")
+            self.index = json.loads(self.zf.read("index.json").decode("utf-8"))
+        else:
+            self.zf = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+            atexit.register(self.close)
+
+    def record(self, key, url, params, resp=None, error=None, elapsed=0.0, max_body=None):
+        entry = {"elapsed": round(elapsed, 4)}
+        entry["url"], entry["params"] = _redact(url, params)
+        if error is not None:
+            entry["error"] = repr(error)
+        else:
+            body = resp.content if max_body is None else resp.raw.read(max_body, decode_content=True)
+            name = "b/" + hashlib.sha1(body).hexdigest()
+            entry.update({"status": resp.status_code, "body": name,
+                          "headers": {k: resp.headers[k] for k in _REPLAY_KEEP_HEADERS if k in resp.headers}})
+        with self._lock:
+            if error is None and name not in self.bodies:
+                self.zf.writestr(name, body); self.bodies.add(name)
+            self.index.setdefault(key, []).append(entry)
+        if error is not None: return None
+        return _ArchivedResponse(url, entry["status"], entry["headers"], body)
+
+    def replay(self, key, url):
+        with self._lock:
+            seq = self.index.get(key) or []
+            if not seq: raise ConnectionError(f"[REPLAY] richiesta non presente in archivio: {_redact(url)[0]}")
+            i = self.cursor.get(key, 0); self.cursor[key] = i+1
+            entry = seq[min(i, len(seq)-1)]
+            body = self.zf.read(entry["body"]) if "body" in entry else b""
+        if HTTP_REPLAY_LATENCY > 0: time.sleep(entry.get("elapsed", 0.0) * HTTP_REPLAY_LATENCY)
+        if "error" in entry: raise ConnectionError(f"[REPLAY] {entry['error']}")
+        return _ArchivedResponse(url, entry["status"], entry.get("headers"), body)
+
+    def close(self):
+        with self._lock:
+            if self.mode != "record" or self.zf is None: return
+            self.zf.writestr("index.json", json.dumps(self.index, separators=(",",":")))
+            self.zf.close(); self.zf = None
+            print(f"[HTTP] Archivio registrato: {self.path} ({sum(len(v) for v in self.index.values())} risposte)")
+
+_http_local = threading.local()
+_http_archive = None
+_http_archive_lock = threading.Lock()
+
+def _http_session():
+    s = getattr(_http_local, "session", None)
+    if s is None:
+        requests = _lazy_import("requests"); _lazy_import("requests.adapters")
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        s.mount("https://", adapter); s.mount("http://", adapter)
+        _http_local.session = s
+    return s
+
+def _get_http_archive():
+    global _http_archive
+    if HTTP_MODE not in ("record","replay"): return None
+    with _http_archive_lock:
+        if _http_archive is None: _http_archive = _HttpArchive(HTTP_ARCHIVE_PATH, HTTP_MODE)
+    return _http_archive
+
+def _http_request(method, url, record_max_bytes=None, deadline=True, **kw):
+    # unico punto per l'HTTP esterno: record/replay (HTTP_MODE), timeout limitato dalla deadline del prodotto
+    dl = _current_deadline() if deadline else None
+    if dl: kw["timeout"] = dl.clip(kw.get("timeout"))
+    arch = _get_http_archive()
+    if arch is None: return _http_session().request(method, url, **kw)
+    key = _http_key(method, url, kw)
+    if arch.mode == "replay": return arch.replay(key, url)
+    t0 = time.monotonic()
+    try:
+        r = _http_session().request(method, url, **kw)
+    except Exception as ex:
+        arch.record(key, url, kw.get("params"), error=ex, elapsed=time.monotonic()-t0)
+        raise
+    with r:
+        stream_cap = record_max_bytes if kw.get("stream") else None
+        return arch.record(key, url, kw.get("params"), resp=r, elapsed=time.monotonic()-t0, max_body=stream_cap)
+
+# === Shopify throttling ===
+class _ShopifyThrottle:
+    # limitatore condiviso: REST su X-Shopify-Shop-Api-Call-Limit, GraphQL su extensions.cost.throttleStatus
+    def __init__(self, rest_size, rest_rate, margin, gql_default_cost):
+        self._lock = threading.Lock()
+        now = time.monotonic()
+        self.margin = max(0.0, min(0.9, margin))
+        self.rest_size = float(rest_size); self.rest_rate = float(rest_rate)
+        self.rest_level = 0.0; self.rest_ts = now
+        self.gql_max = 1000.0; self.gql_rate = 50.0
+        self.gql_avail = self.gql_max; self.gql_ts = now; self.gql_inflight = 0.0
+        self.gql_default_cost = float(gql_default_cost)
+        self.gql_costs = {}
+        self.blocked_until = 0.0
+
+    def _leak(self, now):
+        self.rest_level = max(0.0, self.rest_level - (now-self.rest_ts)*self.rest_rate); self.rest_ts = now
+        self.gql_avail = min(self.gql_max, self.gql_avail + (now-self.gql_ts)*self.gql_rate); self.gql_ts = now
+
+    def acquire_rest(self):
+        while True:
+            with self._lock:
+                now = time.monotonic(); self._leak(now)
+                limit = max(1.0, self.rest_size*(1.0-self.margin))
+                if now >= self.blocked_until and self.rest_level+1.0 <= limit:
+                    self.rest_level += 1.0
+                    return
+                wait = max(self.blocked_until-now, (self.rest_level+1.0-limit)/max(0.1,self.rest_rate))
+            time.sleep(max(0.01, wait))
+
+    def update_rest(self, header_val):
+        try: used, size = [float(x) for x in str(header_val).split("/",1)]
+        except Exception: return
+        with self._lock:
+            self._leak(time.monotonic())
+            self.rest_size = size or self.rest_size
+            self.rest_level = max(self.rest_level, used)
+
+    def estimate_gql(self, query):
+        return self.gql_costs.get(hash(query), self.gql_default_cost)
+
+    def acquire_gql(self, query, cost=None):
+        cost = self.estimate_gql(query) if cost is None else float(cost)
+        while True:
+            with self._lock:
+                now = time.monotonic(); self._leak(now)
+                need = min(cost + self.gql_max*self.margin, self.gql_max)
+                if now >= self.blocked_until and self.gql_avail >= need:
+                    self.gql_avail -= cost; self.gql_inflight += cost
+                    return cost
+                wait = max(self.blocked_until-now, (need-self.gql_avail)/max(1.0,self.gql_rate))
+            time.sleep(max(0.01, wait))
+
+    def release_gql(self, reserved):
+        # richiesta senza risposta utile: il costo prenotato resta scalato dal budget locale
+        with self._lock: self.gql_inflight = max(0.0, self.gql_inflight - reserved)
+
+    def update_gql(self, query, cost_ext, reserved=0.0):
+        with self._lock:
+            self.gql_inflight = max(0.0, self.gql_inflight - reserved)
+            if not isinstance(cost_ext, dict): return
+            st = cost_ext.get("throttleStatus") or {}
+            now = time.monotonic(); self._leak(now)
+            if cost_ext.get("requestedQueryCost") is not None:
+                self.gql_costs[hash(query)] = float(cost_ext["requestedQueryCost"])
+            if st.get("maximumAvailable"): self.gql_max = float(st["maximumAvailable"])
+            if st.get("restoreRate"): self.gql_rate = float(st["restoreRate"])
+            if st.get("currentlyAvailable") is not None:
+                # il server ha già reso la differenza tra costo richiesto ed effettivo; restano da scalare le altre in volo
+                self.gql_avail = float(st["currentlyAvailable"]) - self.gql_inflight
+
+    def backoff(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic()+max(0.0, seconds))
+
+SHOPIFY_THROTTLE = _ShopifyThrottle(SHOPIFY_REST_BUCKET_SIZE, SHOPIFY_REST_LEAK_RATE, SHOPIFY_THROTTLE_MARGIN, SHOPIFY_GQL_DEFAULT_COST)
+
+def _retry_after_sec(r, attempt):
+    try: return max(0.5, float(r.headers.get("Retry-After")))
+    except Exception: return min(30.0, 1.0 * (2 ** attempt))
+
+def _gql_throttled(errors):
+    for e in errors if isinstance(errors, list) else []:
+        if safe_get(e, "extensions", "code") == "THROTTLED": return True
+    return False
+
+def shopify_graphql(q, vars_=None, cost_hint=None):
     url=f"https://{STORE}/admin/api/{APIV}/graphql.json"
     h={"X-Shopify-Access-Token":TOKEN,"Content-Type":"application/json"}
-    r=requests.post(url,json={"query":q,"variables":vars_ or {}},headers=h,timeout=30)
-    r.raise_for_status()
-    j=r.json()
-    if "errors" in j: raise RuntimeError(j["errors"])
-    return j["data"]
+    for attempt in range(SHOPIFY_MAX_RETRIES+1):
+        held=SHOPIFY_THROTTLE.acquire_gql(q, cost_hint)
+        try:
+            r=_http_request("POST",url,json={"query":q,"variables":vars_ or {}},headers=h,timeout=30,deadline=False)
+            if r.status_code==429 and attempt<SHOPIFY_MAX_RETRIES:
+                wait=_retry_after_sec(r, attempt); SHOPIFY_THROTTLE.backoff(wait)
+                if DEBUG: print(f"[THROTTLE] GraphQL 429, attendo {wait:.1f}s")
+                continue
+            r.raise_for_status()
+            j=r.json()
+            cost=safe_get(j,"extensions","cost")
+            SHOPIFY_THROTTLE.update_gql(q, cost, held); held=0
+        finally:
+            if held: SHOPIFY_THROTTLE.release_gql(held)
+        if "errors" in j and _gql_throttled(j["errors"]) and attempt<SHOPIFY_MAX_RETRIES:
+            st=safe_get(cost,"throttleStatus",default={}) or {}
+            need=float(safe_get(cost,"requestedQueryCost",default=SHOPIFY_THROTTLE.estimate_gql(q)) or 0)
+            wait=max(0.5,(need-float(st.get("currentlyAvailable") or 0))/max(1.0,float(st.get("restoreRate") or 50)))
+            SHOPIFY_THROTTLE.backoff(wait)
+            if DEBUG: print(f"[THROTTLE] GraphQL THROTTLED, attendo {wait:.1f}s")
+            continue
+        if "errors" in j: raise RuntimeError(j["errors"])
+        return j["data"]
+
+def _shopify_rest(method, url, **kw):
+    if method.upper() != "GET": _lease_check()
+    h = {"X-Shopify-Access-Token": TOKEN, "Content-Type": "application/json"}
+    for attempt in range(SHOPIFY_MAX_RETRIES+1):
+        SHOPIFY_THROTTLE.acquire_rest()
+        r = _http_request(method, url, headers=h, timeout=30, deadline=False, **kw)
+        SHOPIFY_THROTTLE.update_rest(r.headers.get("X-Shopify-Shop-Api-Call-Limit"))
+        if r.status_code==429 and attempt<SHOPIFY_MAX_RETRIES:
+            wait=_retry_after_sec(r, attempt); SHOPIFY_THROTTLE.backoff(wait)
+            if DEBUG: print(f"[THROTTLE] REST 429, attendo {wait:.1f}s")
+            continue
+        return r
 
 def add_image(product_id_num: int, image_src: str, alt_text: str=""):
     url = f"https://{STORE}/admin/api/{APIV}/products/{product_id_num}/images.json"
-    h = {"X-Shopify-Access-Token": TOKEN, "Content-Type": "application/json"}
     payload = {"image": {"src": image_src, "alt": (alt_text or "")[:255]}}
-    r = requests.post(url, json=payload, headers=h, timeout=30)
+    r = _shopify_rest("POST", url, json=payload)
     r.raise_for_status()
     return safe_get(r.json(), "image", "id")
 
 def add_image_attachment(product_id_num:int, image_bytes:bytes, filename:str="image.jpg", alt_text:str=""):
     url = f"https://{STORE}/admin/api/{APIV}/products/{product_id_num}/images.json"
-    h = {"X-Shopify-Access-Token": TOKEN, "Content-Type": "application/json"}
     b64 = base64.b64encode(image_bytes).decode("ascii")
     payload = {"image": {"attachment": b64, "filename": filename, "alt": (alt_text or "")[:255]}}
-    r = requests.post(url, json=payload, headers=h, timeout=30)
+    r = _shopify_rest("POST", url, json=payload)
     r.raise_for_status()
     return safe_get(r.json(), "image", "id")
 
 def update_description(product_id_num: int, body_html: str):
     url = f"https://{STORE}/admin/api/{APIV}/products/{product_id_num}.json"
-    h = {"X-Shopify-Access-Token": TOKEN, "Content-Type": "application/json"}
-    r = requests.put(url, json={"product": {"id": product_id_num, "body_html": body_html}}, headers=h, timeout=30)
+    r = _shopify_rest("PUT", url, json={"product": {"id": product_id_num, "body_html": body_html}})
     r.raise_for_status()
     return True
 
 def create_or_update_metafield(product_id_num:int, namespace:str, key:str, value:str, value_type="single_line_text_field"):
     url = f"https://{STORE}/admin/api/{APIV}/metafields.json"
-    h = {"X-Shopify-Access-Token": TOKEN, "Content-Type": "application/json"}
     payload = {
         "metafield":{
             "namespace": namespace,
@@ -161,7 +729,7 @@ def create_or_update_metafield(product_id_num:int, namespace:str, key:str, value
             "owner_id": product_id_num
         }
     }
-    r = requests.post(url, json=payload, headers=h, timeout=30)
+    r = _shopify_rest("POST", url, json=payload)
     if r.status_code == 422:
         q = """
         query($id:ID!){
@@ -180,11 +748,114 @@ def create_or_update_metafield(product_id_num:int, namespace:str, key:str, value
                 mutation($id:ID!, $val:String!){
                   metafieldsSet(metafields:[{id:$id, value:$val, type:"%s"}]){ userErrors{ field message } }
                 }""" % value_type
+                _lease_check()
                 shopify_graphql(mq, {"id": mid, "val": value})
                 return True
     r.raise_for_status()
     return True
 
+# === Write-behind batcher (descrizioni + metafield) ===
+_GQL_MUTATION_COST = 10
+_METAFIELDS_SET_MAX = 25
+
+class _ShopifyWriteBatcher:
+    # descrizioni e metafield di più prodotti in un'unica mutation aliasata, entro SHOPIFY_BATCH_MAX_COST
+    def __init__(self, max_products, max_cost):
+        self._lock = threading.Lock()
+        self.max_products = max(1, max_products)
+        self.max_cost = max(2*_GQL_MUTATION_COST, max_cost)
+        self.pending = {}
+        self.rows = {}
+
+    def _entry(self, pid):
+        return self.pending.setdefault(pid, {"desc": None, "metafields": [], "lease": _current_lease()})
+
+    def queue_description(self, pid, body_html):
+        with self._lock: self._entry(pid)["desc"] = body_html
+
+    def queue_metafield(self, pid, namespace, key, value, value_type="single_line_text_field"):
+        with self._lock:
+            self._entry(pid)["metafields"].append({"ownerId": f"gid://shopify/Product/{pid}", "namespace": namespace,
+                                                   "key": key, "value": value, "type": value_type})
+
+    def commit_row(self, pid, row_dict):
+        # batch pieno: si scrivono solo i prodotti conclusi, quelli in lavorazione restano in coda
+        with self._lock:
+            if pid in self.pending: self.rows[pid] = row_dict
+            full = len(self.rows) >= self.max_products
+            done = list(self.rows)
+        if full: self.flush(pids=done)
+
+    def _chunks(self, items):
+        chunk=[]; n_desc=0; n_mf=0
+        for pid, e in items:
+            d2 = n_desc + (1 if e["desc"] is not None else 0); m2 = n_mf + len(e["metafields"])
+            cost = _GQL_MUTATION_COST * (d2 + -(-m2 // _METAFIELDS_SET_MAX))
+            if chunk and (cost > self.max_cost or len(chunk) >= self.max_products):
+                yield chunk; chunk=[]; d2 = 1 if e["desc"] is not None else 0; m2 = len(e["metafields"])
+            chunk.append((pid, e)); n_desc, n_mf = d2, m2
+        if chunk: yield chunk
+
+    def flush(self, pids=None):
+        # pids: solo quei prodotti (es. il job del worker corrente)
+        with self._lock:
+            keys = list(self.pending) if pids is None else [p for p in pids if p in self.pending]
+            items = [(p, self.pending.pop(p)) for p in keys]
+            rows = {p: self.rows.pop(p) for p in keys if p in self.rows}
+        if not items: return {}
+        errors = {}
+        fenced = {pid for pid, e in items if e["lease"] is not None and not e["lease"].valid()}
+        for pid in fenced: errors[pid] = ["lease persa: scritture annullate"]
+        for chunk in self._chunks([x for x in items if x[0] not in fenced]):
+            for pid, msgs in self._send(chunk).items():
+                errors.setdefault(pid, []).extend(msgs)
+        for pid, e in items:
+            r = rows.get(pid); msgs = errors.get(pid) or []
+            if not r or not msgs: continue
+            if any(m.startswith("descrizione") for m in msgs): r["description_updated"] = False
+            r["notes"] = "; ".join([x for x in [r.get("notes")] + msgs if x])
+        if DEBUG or errors:
+            print(f"[BATCH] Flush scritture: {len(items)} prodotti, {len(errors)} con errori")
+        for pid, msgs in errors.items():
+            print(f"  - ERRORE batch prodotto {pid}: {'; '.join(msgs)}")
+        return errors
+
+    def _send(self, chunk):
+        decl=[]; body=[]; vars_={}; mf_slots=[]
+        for i, (pid, e) in enumerate(chunk):
+            if e["desc"] is None: continue
+            decl += [f"$id{i}:ID!", f"$d{i}:String!"]
+            vars_[f"id{i}"] = f"gid://shopify/Product/{pid}"; vars_[f"d{i}"] = e["desc"]
+            body.append(f"d{i}: productUpdate(input:{{id:$id{i}, descriptionHtml:$d{i}}}){{ userErrors{{ field message }} }}")
+        mfs = [(pid, m) for pid, e in chunk for m in e["metafields"]]
+        for j in range(0, len(mfs), _METAFIELDS_SET_MAX):
+            part = mfs[j:j+_METAFIELDS_SET_MAX]; k = len(mf_slots)
+            decl.append(f"$mf{k}:[MetafieldsSetInput!]!"); vars_[f"mf{k}"] = [m for _, m in part]
+            body.append(f"m{k}: metafieldsSet(metafields:$mf{k}){{ userErrors{{ field message }} }}")
+            mf_slots.append([pid for pid, _ in part])
+        q = "mutation(%s){\n  %s\n}" % (", ".join(decl), "\n  ".join(body))
+        errors = {}
+        try:
+            data = shopify_graphql(q, vars_, cost_hint=_GQL_MUTATION_COST*len(body)) or {}
+        except Exception as ex:
+            for pid, e in chunk:
+                if e["desc"] is not None: errors.setdefault(pid, []).append(f"descrizione: {ex}")
+                if e["metafields"]: errors.setdefault(pid, []).append(f"metafield: {ex}")
+            return errors
+        for i, (pid, e) in enumerate(chunk):
+            for ue in safe_get(data, f"d{i}", "userErrors", default=[]) or []:
+                errors.setdefault(pid, []).append(f"descrizione: {ue.get('message')}")
+        for k, owners in enumerate(mf_slots):
+            for ue in safe_get(data, f"m{k}", "userErrors", default=[]) or []:
+                f = ue.get("field") or []
+                idx = int(f[1]) if len(f) > 1 and str(f[1]).isdigit() else None
+                targets = [owners[idx]] if idx is not None and idx < len(owners) else sorted(set(owners))
+                for pid in targets:
+                    errors.setdefault(pid, []).append(f"metafield: {ue.get('message')}")
+        return errors
+
+SHOPIFY_WRITES = _ShopifyWriteBatcher(SHOPIFY_WRITE_BATCH_SIZE, SHOPIFY_BATCH_MAX_COST)
+
 # === SKU helpers ===
 def sku_root(s: str) -> str:
     s = safe_strip(s)
@@ -287,6 +958,17 @@ def fallback_scan_draft_products_and_filter(terms, limit_pages=6):
     if DEBUG: print(f"[DEBUG] fallback matched products: {len(out)} (pages scanned: {pages+1})")
     return list(out.values())
 
+def fetch_product_by_gid(gid):
+    q = """
+    query($id:ID!){
+      product(id:$id){
+        id title vendor productType handle status bodyHtml tags
+        images(first:1){ edges{ node{ id } } }
+        variants(first:100){ edges{ node{ id sku barcode title selectedOptions{ name value } } } }
+      }
+    }"""
+    return safe_get(shopify_graphql(q, {"id": gid}), "product")
+
 # === Google/Bing search ===
 def bing_image_search(qry,count=50,pages=2):
     if not BING_IMAGE_KEY: return []
@@ -297,10 +979,12 @@ def bing_image_search(qry,count=50,pages=2):
         params={"q":qry,"safeSearch":"Strict","count":count,"offset":p*count,
                 "imageType":"Photo","imageContent":"Product","license":"Any"}
         try:
-            r=requests.get(url,headers=h,params=params,timeout=20); r.raise_for_status()
+            r=_http_request("GET",url,headers=h,params=params,timeout=20); r.raise_for_status()
             for it in r.json().get("value",[]):
                 if it.get("contentUrl"):
                     out.append({"content":it.get("contentUrl"),"context":it.get("hostPageUrl")})
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             print(f"[Bing ERROR] {e}"); break
     return out
@@ -313,13 +997,15 @@ def google_cse_image_search(qry, per_page=10, pages=3):
         params={"key":GOOGLE_CSE_KEY,"cx":GOOGLE_CSE_CX,"q":qry,"searchType":"image","num":per_page,
                 "start":start,"safe":"active","imgType":"photo"}
         try:
-            r=requests.get(base,params=params,timeout=20)
+            r=_http_request("GET",base,params=params,timeout=20)
             if r.status_code>=400:
                 try: print(f"[Google CSE ERROR {r.status_code}] {r.json()}")
                 except: print(f"[Google CSE ERROR {r.status_code}] {r.text}")
                 break
             for it in r.json().get("items",[]) or []:
                 out.append({"content":it.get("link"),"context":safe_get(it,"image","contextLink")})
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             print(f"[Google CSE EXC] {e}"); break
     return out
@@ -328,19 +1014,24 @@ def google_cse_web_search(qry, num=8):
     if not (GOOGLE_CSE_KEY and GOOGLE_CSE_CX): return []
     base="https://www.googleapis.com/customsearch/v1"
     try:
-        r=requests.get(base, params={"key":GOOGLE_CSE_KEY,"cx":GOOGLE_CSE_CX,"q":qry,"num":num,"safe":"active"}, timeout=20)
+        r=_http_request("GET",base, params={"key":GOOGLE_CSE_KEY,"cx":GOOGLE_CSE_CX,"q":qry,"num":num,"safe":"active"}, timeout=20)
         if r.status_code>=400: return []
         return r.json().get("items",[]) or []
+    except DeadlineExceeded:
+        raise
     except Exception:
         return []
 
 def _http_get_text(url, limit_bytes=250000):
     try:
-        with requests.get(url, timeout=10, stream=True) as r:
+        with HOST_SCHEDULER.slot(domain(url)) as slot, \
+             _http_request("GET", url, timeout=10, stream=True, record_max_bytes=4*limit_bytes+1) as r:
+            HOST_SCHEDULER.feedback(slot, r.status_code, r.headers.get("Retry-After"))
             r.raise_for_status()
             total=0; chunks=[]
             for ch in r.iter_content(8192):
                 if not ch: continue
+                _deadline_check()
                 try: t = ch.decode("utf-8","ignore")
                 except: t = ch.decode("latin-1","ignore")
                 total += len(t)
@@ -348,22 +1039,197 @@ def _http_get_text(url, limit_bytes=250000):
                     chunks.append(t[:max(0,limit_bytes-(total-len(t)))]); break
                 chunks.append(t)
             return "".join(chunks)
+    except DeadlineExceeded:
+        raise
     except Exception:
         return ""
 
-def _download_bytes(url):
+def _download_bytes(url, budget=None, share=None):
+    # con budget restano prenotati len(bytes), da rilasciare al chiamante
+    held = 0; ok = False
     try:
-        with requests.get(url,stream=True,timeout=DOWNLOAD_TIMEOUT_SEC) as r:
+        if budget is not None:   # si prenota il massimo prima di slot e connessione: l'attesa non blocca l'host
+            held = budget.acquire(MAX_DOWNLOAD_BYTES, timeout=_deadline_remaining(), share=share)
+            if held is None: held = 0; _deadline_check(); raise DeadlineExceeded("memoria")
+        with HOST_SCHEDULER.slot(domain(url)) as slot, \
+             _http_request("GET",url,stream=True,timeout=DOWNLOAD_TIMEOUT_SEC,record_max_bytes=MAX_DOWNLOAD_BYTES+1) as r:
+            HOST_SCHEDULER.feedback(slot, r.status_code, r.headers.get("Retry-After"))
             r.raise_for_status()
+            try: need = int(r.headers.get("Content-Length") or 0)
+            except ValueError: need = 0
+            if need > MAX_DOWNLOAD_BYTES: return None
+            if budget is not None and 0 < need < held and not r.headers.get("Content-Encoding"):
+                budget.release(held - need); held = need
             total=0; parts=[]
             for ch in r.iter_content(8192):
                 if ch:
+                    _deadline_check()
                     total+=len(ch)
-                    if total>MAX_DOWNLOAD_BYTES: return None
+                    if total>MAX_DOWNLOAD_BYTES or (budget is not None and total>held): return None
                     parts.append(ch)
-            return b"".join(parts)
+            data = b"".join(parts); ok = True
+            if budget is not None: budget.release(held - len(data))
+            return data
+    except DeadlineExceeded:
+        raise
     except Exception:
         return None
+    finally:
+        if budget is not None and not ok and held: budget.release(held)
+
+# === Host scheduler (cortesia verso i retailer) ===
+class _HostState:
+    __slots__ = ("sem","lock","next_at","delay")
+    def __init__(self, conc, delay):
+        self.sem = threading.BoundedSemaphore(conc); self.lock = threading.Lock()
+        self.next_at = 0.0; self.delay = delay
+
+class _HostScheduler:
+    # per host: al massimo HOST_MAX_CONCURRENCY richieste e 'delay' tra gli avvii (cresce su 429/503)
+    def __init__(self, conc, min_delay, max_delay):
+        self.conc = conc; self.min_delay = min_delay; self.max_delay = max_delay
+        self._lock = threading.Lock(); self.hosts = {}
+
+    def _state(self, host):
+        with self._lock:
+            st = self.hosts.get(host)
+            if st is None: st = self.hosts[host] = _HostState(self.conc, self.min_delay)
+            return st
+
+    @contextlib.contextmanager
+    def slot(self, host):
+        st = self._state(host)
+        rem = _deadline_remaining()
+        if not st.sem.acquire(timeout=rem):
+            _deadline_check(); raise DeadlineExceeded("host")
+        try:
+            while True:
+                with st.lock:
+                    now = time.monotonic(); wait = st.next_at - now
+                    if wait <= 0:
+                        st.next_at = now + st.delay; break
+                rem = _deadline_remaining()
+                if rem is not None and rem < wait:
+                    _deadline_check(); raise DeadlineExceeded("host")
+                time.sleep(wait)
+            yield st
+        finally:
+            st.sem.release()
+
+    def feedback(self, st, status, retry_after=None):
+        with st.lock:
+            if status in (429, 503):
+                try: ra = float(retry_after) if retry_after else 0.0
+                except ValueError: ra = 0.0
+                st.delay = min(self.max_delay, max(st.delay*2, self.min_delay or 0.5, ra))
+                st.next_at = max(st.next_at, time.monotonic() + st.delay)
+                if DEBUG: print(f"[HOST] {status}: rallento a {st.delay:.1f}s tra le richieste")
+            elif status < 400:
+                st.delay = max(self.min_delay, st.delay*0.8)
+
+HOST_SCHEDULER = _HostScheduler(HOST_MAX_CONCURRENCY, HOST_MIN_DELAY_SEC, HOST_MAX_DELAY_SEC)
+
+def _prefetch_ordered(items, fn, window=None, discard=None):
+    # fetch in anticipo su thread, risultati in ordine; alla chiusura i non consumati vanno a discard()
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError as _FutTimeout
+    window = window or FETCH_CONCURRENCY
+    dl = _current_deadline()
+    def run(it):
+        _deadline_local.current = dl
+        try: return fn(it)
+        finally: _deadline_local.current = None
+    items = iter(items); pending = collections.deque()
+    ex = ThreadPoolExecutor(max_workers=window)
+    try:
+        for it in items:
+            pending.append((it, ex.submit(run, it)))
+            if len(pending) >= window: break
+        while pending:
+            it, fut = pending.popleft()
+            nxt = next(items, _prefetch_ordered)
+            if nxt is not _prefetch_ordered: pending.append((nxt, ex.submit(run, nxt)))
+            rem = _deadline_remaining()
+            try: res = fut.result(timeout=rem)
+            except _FutTimeout:
+                pending.appendleft((it, fut)); _deadline_check(); raise DeadlineExceeded("fetch")
+            yield it, res
+    finally:
+        def _drop(f):
+            if discard is None or f.cancelled() or f.exception() is not None: return
+            try: discard(f.result())
+            except Exception: pass
+        for _, fut in pending:
+            if not fut.cancel(): fut.add_done_callback(_drop)
+        ex.shutdown(wait=False, cancel_futures=True)
+
+# === Memory budget (immagini in lavorazione) ===
+class _MemoryBudget:
+    # budget condiviso tra worker per i buffer delle immagini in lavorazione
+    def __init__(self, total_bytes):
+        self.total = max(1, int(total_bytes)); self.used = 0
+        self._cond = threading.Condition(); self._waiting = collections.deque()
+
+    def _admissible(self, n):
+        if self.used + n <= self.total: return True
+        # oltre il budget solo se tutta la memoria in uso è di pipeline ferme qui: nessuno la libererebbe
+        blocked = {id(s): s.held for _, s in self._waiting if s is not None}
+        return self.used <= sum(blocked.values())
+
+    def acquire(self, n, timeout=None, share=None):
+        # ammissione FIFO; share (_MemoryShare) = body prefetchati della pipeline chiamante
+        n = min(max(0, int(n)), self.total)
+        end = None if timeout is None else time.monotonic() + timeout
+        me = (object(), share)
+        with self._cond:
+            self._waiting.append(me); self._cond.notify_all()   # un nuovo fermo può sbloccare la testa
+            try:
+                while self._waiting[0] is not me or not self._admissible(n):
+                    left = None if end is None else end - time.monotonic()
+                    if left is not None and left <= 0: return None
+                    self._cond.wait(left)
+                self.used += n
+            finally:
+                self._waiting.remove(me); self._cond.notify_all()
+        return n
+
+    def try_acquire(self, n):
+        n = min(max(0, int(n)), self.total)
+        with self._cond:
+            if self._waiting or (self.used and self.used + n > self.total): return None
+            self.used += n
+        return n
+
+    def release(self, n):
+        with self._cond:
+            self.used = max(0, self.used - n); self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, n, share=None):
+        got = self.acquire(n, timeout=_deadline_remaining(), share=share)
+        if got is None: _deadline_check(); raise DeadlineExceeded("memoria")
+        try: yield got
+        finally: self.release(got)
+
+IMAGE_MEMORY = _MemoryBudget(IMAGE_MEMORY_BUDGET_MB * 1024 * 1024)
+
+class _MemoryShare:
+    # memoria tenuta da una pipeline galleria (body scaricati non ancora elaborati)
+    def __init__(self, budget):
+        self.budget = budget; self.held = 0
+
+    def add(self, n):
+        with self.budget._cond: self.held += n; self.budget._cond.notify_all()
+
+    def detach(self, n):
+        # la prenotazione passa a chi la rilascerà direttamente sul budget (es. job nel pool)
+        with self.budget._cond: self.held -= n; self.budget._cond.notify_all()
+
+    def release(self, n):
+        self.detach(n); self.budget.release(n)
+
+def _estimate_image_mem(data_len, w, h):
+    # sorgente + (RGB decodificato, copie per crop/analisi, RGBA rembg, grigio volti) + JPEG e copia base64
+    return int(data_len*3.5 + w*h*14)
 
 # === Image checks & parsing ===
 def _ahash(img, hash_size=8):
@@ -423,9 +1289,120 @@ def _context_has_code(text, code):
     c=re.escape(code)
     return re.search(rf"(^|[^A-Za-z0-9]){c}([^A-Za-z0-9]|$)", text or "", re.I) is not None
 
+# === Page evidence (fatti per pagina calcolati una volta) ===
+class _KeywordAutomaton:
+    # una sola regex con lookahead: a ogni posizione la parola più lunga, poi i suoi prefissi
+    def __init__(self, words):
+        self.words = sorted({w for w in words if w}, key=len, reverse=True)
+        self.prefixes = {w: [v for v in self.words if w.startswith(v)] for w in self.words}
+        self.rx = re.compile("(?=(%s))" % "|".join(map(re.escape, self.words))) if self.words else None
+
+    def hits(self, text_lower):
+        found = set()
+        if not self.rx or not text_lower: return found
+        for m in self.rx.finditer(text_lower):
+            w = m.group(1)
+            if w not in found: found.update(self.prefixes[w])
+            if len(found) == len(self.words): break
+        return found
+
+    def any(self, text_lower):
+        return bool(self.rx and text_lower and self.rx.search(text_lower))
+
+_LIFESTYLE_KW = _KeywordAutomaton(LIFESTYLE_HINT_WORDS)
+_NEGATIVE_KW  = _KeywordAutomaton(NEGATIVE_KEYWORDS_IMG)
+_PAGE_KW      = _KeywordAutomaton(LIFESTYLE_HINT_WORDS + NEGATIVE_KEYWORDS_IMG)
+
+class PageEvidence:
+    # fatti di pagina calcolati una volta sola; lo scoring per URL guarda solo l'URL
+    __slots__ = ("text_lower","code_lower","code_in_text","code_in_struct","brand_ok",
+                 "lifestyle_hits","negative_hits","color_lower","color_in_meta")
+
+    def __init__(self, page_text, info, vendor, code, color_pref=""):
+        info = info or {}
+        self.text_lower = (page_text or "").lower()
+        self.code_lower = (code or "").lower()
+        self.code_in_text = _context_has_code(page_text, code)
+        self.code_in_struct = any((safe_strip(info.get(k)) or "").lower()==self.code_lower for k in ["sku","mpn","gtin13","gtin"])
+        self.brand_ok = _brand_like(safe_strip(info.get("brand"))) == _brand_like(vendor)
+        hits = _PAGE_KW.hits(self.text_lower)
+        self.lifestyle_hits = hits & set(LIFESTYLE_HINT_WORDS)
+        self.negative_hits = hits & set(NEGATIVE_KEYWORDS_IMG)
+        self.color_lower = (color_pref or "").lower()
+        cp = self.color_lower
+        self.color_in_meta = bool(cp) and (cp in safe_strip(info.get("color") or "").lower()
+                                           or cp in safe_strip(safe_get(info,"specs","color_hint") or "").lower()
+                                           or cp in self.text_lower)
+
+    def color_match(self, url):
+        return self.color_in_meta or (bool(self.color_lower) and self.color_lower in (url or "").lower())
+
+# === Responsive images (srcset / CDN size hints) ===
+_SIZE_QUERY_KEYS = ("width","w","wid","imwidth","sw","resize")
+_RX_SHOPIFY_SIZE = re.compile(r"_(\d{2,5})x(\d{0,5})(?:_crop_[a-z]+)?(?:@(\d)x)?\.(?:jpe?g|png|webp|gif|avif)$", re.I)
+_RX_CLOUDINARY_W = re.compile(r"/(?:[^/]*,)?w_(\d{2,5})(?:[,/])")
+
+def _cdn_width_hint(url):
+    # larghezza dai parametri CDN (Shopify _800x, ?width=, imgix w=, cloudinary w_800)
+    try:
+        pu = urlparse(url or "")
+        m = _RX_SHOPIFY_SIZE.search(pu.path)
+        if m and m.group(1): return int(m.group(1)) * int(m.group(3) or 1)
+        m = _RX_CLOUDINARY_W.search(pu.path)
+        if m: return int(m.group(1))
+        for kv in pu.query.split("&"):
+            k, _, v = kv.partition("=")
+            if k.lower() in _SIZE_QUERY_KEYS:
+                m = re.match(r"\d{2,5}", v)
+                if m: return int(m.group(0))
+    except Exception:
+        pass
+    return None
+
+def _parse_srcset(val):
+    # [(url, w|None, x|None)] come da specifica HTML
+    out=[]; i=0; n=len(val or "")
+    while i < n:
+        while i < n and (val[i].isspace() or val[i]==","): i+=1
+        j=i
+        while j < n and not val[j].isspace(): j+=1
+        url=val[i:j]; i=j
+        if not url: break
+        desc=""
+        if url.endswith(","):
+            url=url.rstrip(",")
+        else:
+            k=val.find(",", i)
+            k = n if k < 0 else k
+            desc=val[i:k].strip(); i=k+1
+        w=x=None
+        for d in desc.split():
+            try:
+                if d.endswith("w"): w=int(float(d[:-1]))
+                elif d.endswith("x"): x=float(d[:-1])
+            except ValueError: pass
+        out.append((url, w, x))
+    return out
+
+def _srcset_target_width():
+    # IMAGE_MIN_SIDE vale per entrambi i lati: con una foto orizzontale anche l'altezza deve bastare
+    return IMAGE_MIN_SIDE * (1.0 + SRCSET_HEADROOM) * max(1.0, SRCSET_MAX_ASPECT)
+
+def _pick_srcset_variant(entries):
+    # la più piccola abbastanza larga, altrimenti la più grande; senza larghezze l'ultima (storico)
+    if not entries: return None
+    target = _srcset_target_width()
+    known = [(w or _cdn_width_hint(u), u) for u, w, _ in entries]
+    known = [(w, u) for w, u in known if w]
+    if not known or len(known) < len(entries) and max(x or 1 for _, _, x in entries) > 1:
+        return entries[-1][0]
+    ok = [c for c in known if c[0] >= target]
+    return min(ok)[1] if ok else max(known)[1]
+
 def _extract_product_structured(text):
     try:
-        soup=BeautifulSoup(text,"lxml")
+        _lazy_import("lxml.etree")
+        soup=_lazy_import("bs4").BeautifulSoup(text,"lxml")
         meta_title = (soup.title.string if soup.title else "") or ""
         ogt = soup.find("meta",{"property":"og:title"})
         og_title = ogt.get("content","") if ogt else ""
@@ -460,7 +1437,10 @@ def _extract_product_structured(text):
             for attr in ["src","data-src","data-original","data-zoom-image","data-large_image","srcset","data-srcset"]:
                 val=tag.get(attr)
                 if not val: continue
-                if " " in val and "," in val:
+                if attr.endswith("srcset"):
+                    best=_pick_srcset_variant(_parse_srcset(val))
+                    if best: page_imgs.append(best)
+                elif " " in val and "," in val:
                     pairs=[p.strip() for p in val.split(",") if p.strip()]
                     if pairs:
                         best=pairs[-1].split(" ")[0]
@@ -477,34 +1457,54 @@ def _brand_domain_like(vendor, d): return _brand_like(vendor) in d.replace(".","
 # === NO-FACE: OpenCV helper ===
 _cv2 = None
 _cascade = None
+_cascade_lock = threading.Lock()
 def _ensure_face_cascade():
+    if _cascade is not None: return True
+    with _cascade_lock:
+        return _load_face_cascade()
+
+def _load_face_cascade():
     global _cv2, _cascade
+    if _cascade is not None: return True
     if _cv2 is None:
         try:
-            import cv2 as _cv2_mod
-            globals()['_cv2'] = _cv2_mod
+            globals()['_cv2'] = _lazy_import("cv2")
         except Exception as e:
             if DEBUG: print(f"[FACE] OpenCV non disponibile: {e}")
             return False
-    if not os.path.isfile(FACE_CASCADE_PATH):
+    path = _face_cascade_path()
+    if path is None:
         try:
-            r=requests.get(FACE_CASCADE_URL, timeout=15)
-            r.raise_for_status()
-            with open(FACE_CASCADE_PATH,"wb") as f: f.write(r.content)
+            with _warm_timer("cascade_download"):
+                r=_http_request("GET", FACE_CASCADE_URL, timeout=15, deadline=False)
+                r.raise_for_status()
+                with open(FACE_CASCADE_PATH,"wb") as f: f.write(r.content)
+            path = FACE_CASCADE_PATH
             if DEBUG: print(f"[FACE] Scaricato cascade in {FACE_CASCADE_PATH}")
         except Exception as e:
             if DEBUG: print(f"[FACE] Impossibile scaricare cascade: {e}")
             return False
     try:
-        globals()['_cascade'] = _cv2.CascadeClassifier(FACE_CASCADE_PATH)
-        if _cascade.empty():
+        with _warm_timer("cascade"): casc = _cv2.CascadeClassifier(path)
+        if casc.empty():
             if DEBUG: print("[FACE] Cascade vuoto/non valido")
             return False
+        globals()['_cascade'] = casc
     except Exception as e:
         if DEBUG: print(f"[FACE] Errore caricando cascade: {e}")
         return False
     return True
 
+def _face_cascade_path():
+    # None = da scaricare
+    if os.path.isfile(FACE_CASCADE_PATH): return FACE_CASCADE_PATH
+    try:
+        p = os.path.join(_cv2.data.haarcascades, os.path.basename(FACE_CASCADE_PATH))
+        if os.path.isfile(p): return p
+    except Exception:
+        pass
+    return None
+
 def _detect_faces_np(img_pil):
     if not ENFORCE_FACE_DETECTION: return []
     ok = _ensure_face_cascade()
@@ -540,18 +1540,28 @@ def _crop_head_if_present(img_pil):
     return img2, True
 
 # === Background removal (rembg) ===
+_rembg_session = None
+_rembg_lock = threading.Lock()
+def _ensure_rembg_session():
+    global _rembg_session
+    if _rembg_session is None:
+        with _rembg_lock:
+            if _rembg_session is None:
+                new_session = _lazy_import("rembg").new_session
+                with _warm_timer("rembg_session"): _rembg_session = new_session()
+    return _rembg_session
+
 def _remove_bg(image_bytes: bytes) -> bytes or None:
     if not ENABLE_BG_REMOVAL: return None
     try:
         from rembg import remove
-        out = remove(image_bytes)
+        out = remove(image_bytes, session=_ensure_rembg_session())
         return out
     except Exception as e:
         if DEBUG: print(f"[BG] Rimozione sfondo non disponibile/errore: {e}")
         return None
 
-def _to_jpeg_bytes(img_pil, quality=90, background_white_if_alpha=True):
-    from io import BytesIO
+def _flatten_rgb(img_pil, background_white_if_alpha=True):
     img = img_pil
     if img.mode in ("RGBA","LA") and background_white_if_alpha:
         from PIL import Image
@@ -560,10 +1570,38 @@ def _to_jpeg_bytes(img_pil, quality=90, background_white_if_alpha=True):
         img = bg
     elif img.mode != "RGB":
         img = img.convert("RGB")
+    return img
+
+def _save_image(img, fmt, quality):
+    from io import BytesIO
     buf=BytesIO()
-    img.save(buf, format="JPEG", quality=90, optimize=True)
+    if fmt == "webp":
+        img.save(buf, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(buf, format="JPEG", quality=quality, optimize=True, progressive=OUTPUT_PROGRESSIVE)
     return buf.getvalue()
 
+def _to_jpeg_bytes(img_pil, quality=90, background_white_if_alpha=True):
+    return _save_image(_flatten_rgb(img_pil, background_white_if_alpha), "jpeg", quality)
+
+def _encode_output(img_pil):
+    # lato lungo <= OUTPUT_MAX_SIDE; con OUTPUT_TARGET_BYTES bisezione sulla qualità -> (bytes, ext)
+    from PIL import Image
+    fmt = "webp" if OUTPUT_FORMAT == "webp" else "jpeg"
+    img = _flatten_rgb(img_pil)
+    max_side = max(OUTPUT_MAX_SIDE, IMAGE_MIN_SIDE) if OUTPUT_MAX_SIDE > 0 else 0
+    if max_side and max(img.size) > max_side:
+        img = img.copy(); img.thumbnail((max_side, max_side), Image.LANCZOS)
+    data = _save_image(img, fmt, OUTPUT_QUALITY)
+    if OUTPUT_TARGET_BYTES > 0 and len(data) > OUTPUT_TARGET_BYTES:
+        lo, hi, best = OUTPUT_MIN_QUALITY, OUTPUT_QUALITY-1, None
+        while lo <= hi:
+            q = (lo+hi)//2; cand = _save_image(img, fmt, q)
+            if len(cand) <= OUTPUT_TARGET_BYTES: best, lo = cand, q+1
+            else: hi = q-1
+        data = best or _save_image(img, fmt, OUTPUT_MIN_QUALITY)
+    return data, ("webp" if fmt == "webp" else "jpg")
+
 # === Confidence models ===
 def _desc_confidence(vendor, code, info, page_domain, page_text):
     brand_page = _brand_like(safe_strip(info.get("brand"))); brand_prod = _brand_like(vendor)
@@ -580,22 +1618,24 @@ def _desc_confidence(vendor, code, info, page_domain, page_text):
     if REQUIRE_CODE_IN_URL_OR_CTX and not (code_in_struct or code_in_text): return 0.0
     return min(s,1.0)
 
-def _img_confidence(vendor, code, url, ctx, page_text, info):
+def _img_confidence(vendor, code, url, ctx, page_text, info, evidence=None):
+    ev = evidence or PageEvidence(page_text, info, vendor, code)
     d=domain(ctx or url)
-    brand_ok = _brand_like(safe_strip(info.get("brand"))) == _brand_like(vendor)
+    brand_ok = ev.brand_ok
     brand_in_domain = _brand_domain_like(vendor, d)
-    code_in_url = (code or "").lower() in (url or "").lower()
-    code_in_struct = any((safe_strip(info.get(k)) or "").lower()==(code or "").lower() for k in ["sku","mpn","gtin13","gtin"])
-    code_in_text = _context_has_code(page_text, code)
+    code_in_url = ev.code_lower in (url or "").lower()
+    code_in_struct = ev.code_in_struct
+    code_in_text = ev.code_in_text
     s = 0.0
     s += _bool_score(code_in_url,        0.35)
     s += _bool_score(code_in_struct,     0.35)
     s += _bool_score(code_in_text,       0.20)
     s += _bool_score(brand_ok,           0.25)
     s += _bool_score(brand_in_domain,    0.20)
-    if any(w in d for w in BRAND_DOMAINS_WHITELIST): s += 0.25
-    elif any(w in d for w in TRUSTED_RETAILER_DOMAINS): s += 0.15
-    if REQUIRE_TRUSTED_DOMAIN_IMG and not (any(w in d for w in BRAND_DOMAINS_WHITELIST) or any(w in d for w in TRUSTED_RETAILER_DOMAINS)): return 0.0
+    hc = classify_host(d)
+    if hc.brand_whitelisted: s += 0.25
+    elif hc.trusted_retailer: s += 0.15
+    if REQUIRE_TRUSTED_DOMAIN_IMG and not hc.trusted: return 0.0
     if REQUIRE_BRAND_MATCH and not (brand_ok or brand_in_domain): return 0.0
     if REQUIRE_CODE_IN_URL_OR_CTX and not (code_in_url or code_in_struct or code_in_text): return 0.0
     return min(s, 1.0)
@@ -604,25 +1644,25 @@ def _img_confidence(vendor, code, url, ctx, page_text, info):
 def collect_candidate_images(queries, vendor="", code=""):
     items=[]; seen=set()
     for q in queries:
+        _deadline_check()
         g=google_cse_image_search(q, per_page=10, pages=3) if (GOOGLE_CSE_KEY and GOOGLE_CSE_CX) else []
         b=bing_image_search(q, count=50, pages=2) if BING_IMAGE_KEY else []
         for it in (g+b):
             c=it.get("content"); ctx=it.get("context")
             if not c or c in seen: continue
-            d=domain(c)
-            if any(bad in d for bad in DOMAINS_BLACKLIST): continue
+            if classify_host(domain(c)).blacklisted: continue
             seen.add(c); items.append({"content":c,"context":ctx})
     items.sort(key=lambda it: score_image_url(it["content"], vendor))
     return items
 
 def score_image_url(u,vendor=""):
-    d=domain(u or ""); s=0
-    if any(wh in d for wh in BRAND_DOMAINS_WHITELIST if wh): s-=8
-    if any(wh in d for wh in TRUSTED_RETAILER_DOMAINS if wh): s-=5
+    d=domain(u or ""); s=0; hc=classify_host(d)
+    if hc.brand_whitelisted: s-=8
+    if hc.trusted_retailer: s-=5
     if vendor and _brand_domain_like(vendor, d): s-=3
-    if any(h in d for h in SAFE_DOMAINS_HINTS): s-=1
+    if hc.safe_hint: s-=1
     if any(k in (u or "").lower() for k in WHITE_BG_KEYWORDS): s-=1
-    if any(b in d for b in DOMAINS_BLACKLIST): s+=10
+    if hc.blacklisted: s+=10
     return s
 
 # === ITALIAN normalization ===
@@ -647,6 +1687,146 @@ def _to_italian_material(s:str)->str:
         if k in low: return re.sub(re.escape(k), v, low).strip()
     return s
 
+# === Process pool per le fasi CPU-bound ===
+_image_pool_obj = None
+_image_pool_lock = threading.Lock()
+
+def _image_worker_init():
+    # ogni processo carica cascade e modello rembg una sola volta
+    _prewarm_workers()
+
+def _image_pool():
+    # None con IMAGE_WORKERS=0 (elaborazione nel processo)
+    global _image_pool_obj
+    if IMAGE_WORKERS <= 0: return None
+    with _image_pool_lock:
+        if _image_pool_obj is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _image_pool_obj = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                                  initializer=_image_worker_init)
+            atexit.register(_image_pool_obj.shutdown, wait=True, cancel_futures=True)
+    return _image_pool_obj
+
+def _discard_pool_result(fut):
+    # risultato arrivato dopo cancellazione/deadline: libera solo la shared memory
+    try: _pool_result(fut)
+    except Exception: pass
+
+def _shm_from_bytes(data):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    shm.buf[:len(data)] = data
+    return shm
+
+def _pool_finalize(shm_name, size):
+    # nel worker: immagine dalla shared memory, risultato in un nuovo blocco
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try: data = bytes(shm.buf[:size])
+    finally: shm.close()
+    stats = _FilterStats()
+    res = _finalize_image(data, stats)
+    if not res: return None, stats.counts
+    enc, ext, hcode = res
+    out = _shm_from_bytes(enc)
+    name = out.name; out.close()
+    return (name, len(enc), ext, hcode), stats.counts
+
+def _pool_result(fut, timeout=None):
+    from concurrent.futures import TimeoutError as _FutTimeout
+    try: r, counts = fut.result(timeout=timeout)
+    except _FutTimeout: _deadline_check(); raise DeadlineExceeded("pool")
+    if not r: return None, counts
+    from multiprocessing import shared_memory
+    name, size, ext, hcode = r
+    shm = shared_memory.SharedMemory(name=name)
+    try: enc = bytes(shm.buf[:size])
+    finally: shm.close(); shm.unlink()
+    return (enc, ext, hcode), counts
+
+# === Colore dominante (Lab) ===
+# riferimenti sRGB per i nomi italiani di IT_COLOR_MAP
+IT_COLOR_RGB = {
+    "bianco":(245,245,245), "bianco antico":(243,233,213), "nero":(22,22,22), "blu navy":(25,32,72), "blu":(35,75,170),
+    "rosso":(190,30,40), "verde":(45,125,65), "giallo":(235,200,45), "beige":(215,195,160), "marrone":(105,70,45),
+    "rosa":(235,160,185), "grigio":(130,130,130),
+}
+# tonalità vicine accettate come stesso colore (es. "blu" su un capo navy)
+IT_COLOR_FAMILY = {"blu":["blu navy"], "blu navy":["blu"], "bianco":["bianco antico"], "bianco antico":["bianco","beige"],
+                   "beige":["bianco antico"]}
+
+def _rgb_to_lab(rgb):
+    # sRGB uint8 (N,3) -> CIELAB D65, vettorizzato
+    import numpy as np
+    c = rgb.astype(np.float32) / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124, 0.3576, 0.1805], [0.2126, 0.7152, 0.0722], [0.0193, 0.1192, 0.9505]], dtype=np.float32).T
+    xyz /= np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16.0/116.0)
+    return np.stack([116.0*f[:,1] - 16.0, 500.0*(f[:,0] - f[:,1]), 200.0*(f[:,1] - f[:,2])], axis=1)
+
+@functools.lru_cache(maxsize=1)
+def _color_refs_lab():
+    import numpy as np
+    names = list(IT_COLOR_RGB)
+    return names, _rgb_to_lab(np.array([IT_COLOR_RGB[n] for n in names], dtype=np.uint8))
+
+def _foreground_lab(src):
+    # proxy piccolo (JPEG in draft) -> (Lab del soggetto, Lab dello sfondo stimato dal bordo)
+    import numpy as np
+    from PIL import Image
+    from io import BytesIO
+    if isinstance(src, (bytes, bytearray)):
+        im = Image.open(BytesIO(src))
+        if im.format == "JPEG": im.draft("RGB", (PIXEL_PROXY_SIDE*2, PIXEL_PROXY_SIDE*2))   # prima di qualsiasi load
+    else:
+        im = src
+    im = im.convert("RGB"); im.thumbnail((PIXEL_PROXY_SIDE, PIXEL_PROXY_SIDE))
+    a = np.asarray(im, dtype=np.uint8); h, w = a.shape[:2]
+    lab = _rgb_to_lab(a.reshape(-1, 3)).reshape(h, w, 3)
+    bw, bh = max(1, int(w*WHITE_BG_BORDER_PCT)), max(1, int(h*WHITE_BG_BORDER_PCT))
+    border = np.concatenate([lab[:bh].reshape(-1,3), lab[-bh:].reshape(-1,3), lab[:, :bw].reshape(-1,3), lab[:, -bw:].reshape(-1,3)])
+    bg = np.median(border, axis=0)
+    fg = lab[np.linalg.norm(lab - bg, axis=2) > 12.0]
+    if len(fg) < 0.05 * h * w:
+        fg = lab[int(h*0.2):int(h*0.8), int(w*0.2):int(w*0.8)].reshape(-1, 3)
+    return fg, bg
+
+def _dominant_colors(src, fg=None):
+    # [(nome, quota)] dei pixel del soggetto
+    import numpy as np
+    fg = _foreground_lab(src)[0] if fg is None else fg
+    names, refs = _color_refs_lab()
+    if not len(fg): return []
+    nearest = np.argmin(np.linalg.norm(fg[:, None, :] - refs[None, :, :], axis=2), axis=1)
+    counts = np.bincount(nearest, minlength=len(names)) / float(len(fg))
+    return sorted(((names[i], float(counts[i])) for i in range(len(names)) if counts[i] > 0), key=lambda x: -x[1])
+
+def _pixel_color_match(src, color_pref):
+    # colore sconosciuto, uguale allo sfondo (bianco su bianco) o errore: il gate non scarta
+    target = _to_italian_color(color_pref or "").lower()
+    wanted = [n for n in IT_COLOR_RGB if re.search(rf"\b{re.escape(n)}\b", target)]
+    if not wanted: return True
+    wanted = list(dict.fromkeys(wanted + [f for n in wanted for f in IT_COLOR_FAMILY.get(n, [])]))
+    try:
+        import numpy as np
+        fg, bg = _foreground_lab(src)
+        if not len(fg): return True
+        names, refs = _color_refs_lab()
+        idx = [names.index(n) for n in wanted]
+        if float(np.linalg.norm(refs[idx] - bg, axis=1).min()) <= PIXEL_COLOR_MAX_DELTA_E:
+            return True
+        d_all = np.linalg.norm(fg[:, None, :] - refs[None, :, :], axis=2)
+        hit = (d_all[:, idx].min(axis=1) <= PIXEL_COLOR_MAX_DELTA_E) | np.isin(d_all.argmin(axis=1), idx)
+        share = float(hit.mean())
+        if DEBUG and share < PIXEL_COLOR_MIN_SHARE:
+            print(f"  - Scartata: colore pixel {share:.0%} '{'/'.join(wanted)}' (dominanti: {_dominant_colors(src, fg)[:3]})")
+        return share >= PIXEL_COLOR_MIN_SHARE
+    except Exception as e:
+        if DEBUG: print(f"[COLOR] Verifica pixel non disponibile: {e}")
+        return True
+
 # === GALLERY MODE (single-source per prodotto) ===
 def _absolute_urls(base_url, urls):
     out=[]
@@ -662,6 +1842,42 @@ def _absolute_urls(base_url, urls):
             continue
     return out
 
+# === Canonical image URL (varianti della stessa foto) ===
+_SIZE_QUERY_DROP = {"width","height","w","h","wid","hei","q","qlt","quality","fit","crop","auto","fm","format","fmt",
+                    "dpr","v","imwidth","imheight","sw","sh","resize","fl","bg","scale","size","op_sharpen","strip"}
+_RX_SHOPIFY_SUFFIX = re.compile(r"_(?:\d{1,5}x\d{0,5}|x\d{1,5}|pico|icon|thumb|small|compact|medium|large|grande|original|master)"
+                                r"(?:_crop_[a-z]+)?(?:@\dx)?(?=\.[a-z0-9]+$)", re.I)
+_RX_WP_SUFFIX      = re.compile(r"-\d{2,5}x\d{2,5}(?=\.[a-z0-9]+$)", re.I)
+_RX_CLOUDINARY_TX  = re.compile(r"(/(?:image|video)/(?:upload|fetch|private)/)(?:[a-z]{1,3}_[^/]*/)*(?:v\d+/)?", re.I)
+_RX_MAGENTO_CACHE  = re.compile(r"/cache/(?:\d+/[a-z_]+/(?:\d+x\d*/)?)?[0-9a-f]{32}/", re.I)
+
+def _canonical_image_key(url):
+    # stessa foto in misure diverse -> stessa chiave (Shopify, Cloudinary, imgix, WordPress, Magento)
+    try:
+        pu = urlparse(url or "")
+        host = pu.netloc.lower()
+        path = _RX_CLOUDINARY_TX.sub(r"\1", pu.path)
+        path = _RX_MAGENTO_CACHE.sub("/", path)
+        if host == "cdn.shopify.com" or "/cdn/shop/" in path:   # solo CDN Shopify (anche dominio proprio)
+            path = _RX_SHOPIFY_SUFFIX.sub("", path)
+        path = _RX_WP_SUFFIX.sub("", path)
+        q = sorted(kv for kv in pu.query.split("&") if kv and not kv.startswith("$")
+                   and kv.partition("=")[0].lower() not in _SIZE_QUERY_DROP)
+        return host + path + ("?" + "&".join(q) if q else "")
+    except Exception:
+        return url
+
+def _pick_group_variant(urls):
+    # la più piccola sopra soglia, poi l'originale senza misura, poi la più grande
+    if len(urls) == 1: return urls[0]
+    target = _srcset_target_width()
+    sized = [(_cdn_width_hint(u), i, u) for i, u in enumerate(urls)]
+    ok = [c for c in sized if c[0] and c[0] >= target]
+    if ok: return min(ok)[2]
+    unknown = [u for w, _, u in sized if not w]
+    if unknown: return unknown[0]
+    return max(sized)[2]
+
 def _collect_gallery_from_context(ctx_url, page_text=None):
     text = page_text or _http_get_text(ctx_url, limit_bytes=CONTEXT_FETCH_MAX)
     info = _extract_product_structured(text) if text else {}
@@ -669,96 +1885,335 @@ def _collect_gallery_from_context(ctx_url, page_text=None):
     imgs += info.get("og_images",[]) or []
     imgs += info.get("page_images",[]) or []
     imgs = _absolute_urls(ctx_url, imgs)
-    uniq=[]; seen=set()
+    groups={}
     for u in imgs:
         if any(blk in u.lower() for blk in ["sprite","icon","logo","placeholder","thumb"]): continue
-        if u in seen: continue
-        seen.add(u); uniq.append(u)
+        g = groups.setdefault(_canonical_image_key(u), [])
+        if u not in g: g.append(u)
+    uniq=[_pick_group_variant(g) for g in groups.values()]
+    if DEBUG: print(f"[GALLERY] {sum(len(g) for g in groups.values())} URL -> {len(uniq)} immagini distinte")
     return uniq, info, text
 
-def _process_gallery_to_attachments(gallery_urls, vendor, code, page_text, info, color_pref, want_n):
-    from PIL import Image
-    out=[]; seen_hash=[]
-    for url in gallery_urls:
-        if len(out)>=want_n: break
-        d=domain(url)
-        if any(bad in d for bad in DOMAINS_BLACKLIST): continue
-        if _is_lifestyle_url_or_ctx(url, page_text):
-            if REJECT_LIFESTYLE_HINTS: continue
-        if _has_negative_keywords(url, page_text): continue
-
-        data=_download_bytes(url)
-        if not data: continue
+# === Catena filtri galleria ===
+class _FilterStats:
+    # visti/scartati/secondi per filtro; FILTER_STATS conserva lo storico tra le esecuzioni
+    def __init__(self, history=None):
+        self._lock = threading.Lock()
+        self.counts = {}                 # nome -> [visti, scartati, secondi]
+        self.history = history or {}
+
+    def add(self, name, rejected, secs, seen=1):
+        with self._lock:
+            c = self.counts.setdefault(name, [0, 0, 0.0])
+            c[0] += seen; c[1] += int(rejected); c[2] += secs
+
+    def merge(self, counts):
+        for name, (seen, rej, secs) in (counts or {}).items(): self.add(name, rej, secs, seen=seen)
+
+    def totals(self, name):
+        with self._lock:
+            s, r, t = self.counts.get(name, (0, 0, 0.0))
+        hs, hr, ht = self.history.get(name, (0, 0, 0.0))
+        return s+hs, r+hr, t+ht
+
+    def reject_rate(self, name):
+        s, r, _ = self.totals(name)
+        return (r + 1.0) / (s + 2.0)
+
+    def mean_cost(self, name, default):
+        s, _, t = self.totals(name)
+        return t / s if s >= FILTER_WARMUP else default
+
+    def summary(self):
+        with self._lock:
+            return " ".join(f"{k}={c[1]}/{c[0]}({c[2]*1000:.0f}ms)" for k, c in self.counts.items())
+
+    @staticmethod
+    def load(path):
+        if not path or not os.path.isfile(path): return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return {k: tuple(v) for k, v in json.load(f).items()}
+        except Exception as e:
+            print(f"[FILTRI] Storico non leggibile ({path}): {e}"); return {}
+
+    def save(self, path):
+        if not path: return
+        with self._lock:
+            data = {k: list(v) for k, v in self.history.items()}
+            for k, (s, r, t) in self.counts.items():
+                hs, hr, ht = data.get(k, (0, 0, 0.0)); data[k] = [s+hs, r+hr, round(t+ht, 6)]
+            try:
+                tmp = path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f: json.dump(data, f, sort_keys=True)
+                os.replace(tmp, path)
+            except Exception as e:
+                print(f"[FILTRI] Storico non salvato: {e}")
+
+FILTER_STATS = _FilterStats(_FilterStats.load(FILTER_STATS_PATH))
+
+class _GalleryCandidate:
+    __slots__ = ("url","ev","vendor","code","page_text","info","color_pref","w","h","img","data")
+    def __init__(self, url, ev=None, vendor="", code="", page_text="", info=None, color_pref=""):
+        self.url = url; self.ev = ev; self.vendor = vendor; self.code = code
+        self.page_text = page_text; self.info = info; self.color_pref = color_pref
+        self.w = self.h = None; self.img = None; self.data = None
+
+# fase: url (solo URL/pagina) -> probe (header via Range) -> pixels (immagine decodificata)
+#       -> final (nel worker immagine, ordine fisso: il crop precede l'analisi sfondo)
+# cost: stima iniziale in secondi, sostituita dalla media misurata dopo FILTER_WARMUP campioni
+# min_reject: filtro facoltativo, saltato se scarta meno di questa quota (ricampionato 1 volta su 10)
+GalleryFilter = namedtuple("GalleryFilter", "name phase cost fn min_reject", defaults=(None,))
+
+def _probe_image_size(url):
+    # Range sui primi IMAGE_PROBE_BYTES: (w, h, body completo o None) oppure None
+    from PIL import ImageFile
+    try:
+        with HOST_SCHEDULER.slot(domain(url)) as slot, \
+             _http_request("GET", url, stream=True, timeout=DOWNLOAD_TIMEOUT_SEC, record_max_bytes=IMAGE_PROBE_BYTES,
+                           headers={"Range": f"bytes=0-{IMAGE_PROBE_BYTES-1}"}) as r:
+            HOST_SCHEDULER.feedback(slot, r.status_code, r.headers.get("Retry-After"))
+            if r.status_code not in (200, 206): return None
+            p = ImageFile.Parser(); parts = []; total = 0; complete = True
+            for ch in r.iter_content(8192):
+                if not ch: continue
+                parts.append(ch); total += len(ch)
+                if p.image is None: p.feed(ch)
+                if total >= IMAGE_PROBE_BYTES or (p.image is not None and r.status_code == 200):
+                    complete = False; break
+            if p.image is None: return None
+            w, h = p.image.size
+            rng = re.search(r"/(\d+)$", r.headers.get("Content-Range") or "")
+            if r.status_code == 206: complete = bool(rng) and int(rng.group(1)) <= total
+            return w, h, (b"".join(parts) if complete else None)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        return None
 
-        conf = _img_confidence(vendor, code, url, ctx=url, page_text=page_text, info=info)
-        if conf < IMG_CONFIDENCE_THRESHOLD: 
-            continue
+def _filter_probe(c):
+    res = _probe_image_size(c.url)
+    if not res: return True
+    c.w, c.h, c.data = res
+    return c.w>=IMAGE_MIN_SIDE and c.h>=IMAGE_MIN_SIDE
+
+def _filter_faces(c):
+    if not _has_faces(c.img): return True
+    img2, _ = _crop_head_if_present(c.img)
+    if _has_faces(img2):
+        if DEBUG: print("  - Scartata: volti dopo crop")
+        return False
+    c.img = img2
+    return True
 
-        try:
-            from io import BytesIO
-            img=Image.open(BytesIO(data))
-            w,h=img.size
-            if w<IMAGE_MIN_SIDE or h<IMAGE_MIN_SIDE: continue
-
-            if REQUIRE_COLOR_MATCH_IMG and color_pref:
-                cp=color_pref.lower()
-                in_meta = cp in (safe_strip(info.get("color") or "").lower()) \
-                          or cp in (safe_strip(safe_get(info,"specs","color_hint") or "").lower()) \
-                          or cp in (page_text or "").lower()
-                in_url = cp in (url or "").lower()
-                if not (in_meta or in_url):
-                    continue
+def _filter_background(c):
+    from PIL import Image
+    from io import BytesIO
+    if _is_white_bg(c.img): return True
+    if ENABLE_BG_REMOVAL:
+        out_png = _remove_bg(c.data)
+        if out_png:
+            c.img = Image.open(BytesIO(out_png)); return True
+        return not ENFORCE_BG_REMOVAL
+    return ALLOW_COLORED_BG and ACCEPT_COLORED_IF_REMOVE_FAIL and _is_plain_colored_bg(c.img)
+
+class _FilterChain:
+    # filtri di ogni fase ordinati per costo medio / quota storica di scarti
+    FIXED_ORDER = ("final",)
+
+    def __init__(self, filters):
+        self.filters = list(filters); self._plans = 0; self._lock = threading.Lock()
+
+    def plan(self):
+        with self._lock:
+            self._plans += 1; resample = self._plans % 10 == 0
+        out = {}
+        for f in self.filters:
+            if f.min_reject is not None and not resample:
+                seen, _, _ = FILTER_STATS.totals(f.name)
+                if seen >= FILTER_WARMUP and FILTER_STATS.reject_rate(f.name) < f.min_reject: continue
+            out.setdefault(f.phase, []).append(f)
+        for phase, fs in out.items():
+            if phase not in self.FIXED_ORDER:
+                fs.sort(key=lambda f: FILTER_STATS.mean_cost(f.name, f.cost) / FILTER_STATS.reject_rate(f.name))
+        return out
 
-            need_crop = _has_faces(img)
-            if need_crop:
-                img2, _ = _crop_head_if_present(img)
-                if _has_faces(img2):
-                    if DEBUG: print("  - Scartata: volti dopo crop")
-                    continue
-                img = img2
-
-            bg_white = _is_white_bg(img)
-            bg_plain = _is_plain_colored_bg(img) if ALLOW_COLORED_BG else False
-            final_img = img
-            if not bg_white:
-                if bg_plain and ENABLE_BG_REMOVAL:
-                    out_png = _remove_bg(data)
-                    if out_png:
-                        final_img = Image.open(BytesIO(out_png))
-                    elif ENFORCE_BG_REMOVAL:
-                        continue
-                elif not bg_plain and ENABLE_BG_REMOVAL:
-                    out_png = _remove_bg(data)
-                    if out_png:
-                        final_img = Image.open(BytesIO(out_png))
-                    elif ENFORCE_BG_REMOVAL:
-                        continue
-                elif not (bg_plain and ACCEPT_COLORED_IF_REMOVE_FAIL):
-                    continue
+    @staticmethod
+    def run(filters, cand, stats):
+        # nome del primo filtro che scarta, None se il candidato passa
+        for f in filters or ():
+            t = time.perf_counter(); ok = True
+            try: ok = f.fn(cand)
+            finally: stats.add(f.name, not ok, time.perf_counter()-t)
+            if not ok: return f.name
+        return None
 
+GALLERY_FILTERS = _FilterChain([
+    GalleryFilter("host", "url", 2e-6, lambda c: not classify_host(domain(c.url)).blacklisted),
+    *([GalleryFilter("lifestyle", "url", 5e-6, lambda c: not _is_lifestyle_url_or_ctx(c.url, c.ev))] if REJECT_LIFESTYLE_HINTS else []),
+    GalleryFilter("negative_kw", "url", 5e-6, lambda c: not _has_negative_keywords(c.url, c.ev)),
+    *([GalleryFilter("color_word", "url", 2e-6, lambda c: not c.color_pref or c.ev.color_match(c.url))] if REQUIRE_COLOR_MATCH_IMG else []),
+    GalleryFilter("confidence", "url", 2e-5, lambda c: _img_confidence(c.vendor, c.code, c.url, ctx=c.url, page_text=c.page_text,
+                                                                       info=c.info, evidence=c.ev) >= IMG_CONFIDENCE_THRESHOLD),
+    *([GalleryFilter("probe", "probe", 0.15, _filter_probe, IMAGE_PROBE_MIN_REJECT_RATE)] if IMAGE_HEADER_PROBE else []),
+    *([GalleryFilter("pixel_color", "pixels", 0.01, lambda c: not c.color_pref or _pixel_color_match(c.data, c.color_pref))]
+      if PIXEL_COLOR_GATE else []),
+    GalleryFilter("faces", "final", 0.2, _filter_faces),
+    GalleryFilter("background", "final", 1.0, _filter_background),
+])
+
+def _screen_gallery(gallery_urls, vendor, code, page_text, info, color_pref, ev, stats, plan=None, share=None):
+    # fasi economiche (URL, sonda, download, pixel): genera (url, bytes, w, h)
+    from PIL import Image
+    from io import BytesIO
+    plan = plan if plan is not None else GALLERY_FILTERS.plan()
+    cands = [_GalleryCandidate(u, ev, vendor, code, page_text, info, color_pref) for u in gallery_urls]
+    cands = [c for c in cands if _FilterChain.run(plan.get("url"), c, stats) is None]
+
+    # ogni body scaricato resta prenotato in IMAGE_MEMORY (quota share) per len(bytes) finché
+    # non viene scartato qui o, se generato, finché il chiamante non lo rilascia
+    share = share or _MemoryShare(IMAGE_MEMORY)
+    def fetch(c):
+        if _FilterChain.run(plan.get("probe"), c, stats): return None
+        if c.data is not None:   # body completo già letto dalla sonda
+            if IMAGE_MEMORY.acquire(len(c.data), timeout=_deadline_remaining(), share=share) is None:
+                _deadline_check(); raise DeadlineExceeded("memoria")
+        else:
+            t = time.perf_counter(); c.data = _download_bytes(c.url, budget=IMAGE_MEMORY, share=share)
+            stats.add("download", c.data is None, time.perf_counter()-t)
+        if c.data: share.add(len(c.data))
+        return c.data
+
+    def release(data):
+        if data: share.release(len(data))
+
+    for c, data in _prefetch_ordered(cands, fetch, discard=release):
+        if not data: continue
+        try:
+            _deadline_check()
+            t = time.perf_counter()
             try:
-                hcode=_ahash(final_img)
-                if any(_hamming(hcode, prev)<=5 for prev in seen_hash): 
-                    continue
-                seen_hash.append(hcode)
+                c.img = Image.open(BytesIO(data)); c.w, c.h = c.img.size
+                ok = c.w>=IMAGE_MIN_SIDE and c.h>=IMAGE_MIN_SIDE
             except Exception:
-                pass
+                ok = False
+            stats.add("decode", not ok, time.perf_counter()-t)
+            rejected = not ok or _FilterChain.run(plan.get("pixels"), c, stats)
+        except BaseException:
+            release(data); raise
+        finally:
+            c.img = c.data = None
+        if rejected: release(data); continue
+        yield c.url, data, c.w, c.h
+
+def _finalize_image(data, stats=None, plan=None):
+    # fasi CPU-bound (filtri 'final', hash, encoding): (bytes, ext, ahash) oppure None
+    from PIL import Image
+    from io import BytesIO
+    stats = stats if stats is not None else _FilterStats()
+    plan = plan if plan is not None else GALLERY_FILTERS.plan()
+    c = _GalleryCandidate(None); c.data = data; c.img = Image.open(BytesIO(data))
+    if _FilterChain.run(plan.get("final"), c, stats): return None
+    final_img = c.img
+
+    try: hcode=_ahash(final_img)
+    except Exception: hcode=None
+    enc, ext = _encode_output(final_img)
+    return enc, ext, hcode
+
+def _process_gallery_to_attachments(gallery_urls, vendor, code, page_text, info, color_pref, want_n, evidence=None, sink=None,
+                                    stats=None):
+    # con sink ogni immagine finita va subito in upload; senza, si restituiscono le immagini codificate
+    ev = evidence or PageEvidence(page_text, info, vendor, code, color_pref)
+    stats = stats if stats is not None else _FilterStats()
+    plan = GALLERY_FILTERS.plan()
+    out=[]; seen_hash=[]
 
-            jpg_bytes = _to_jpeg_bytes(final_img, quality=90, background_white_if_alpha=True)
-            out.append(jpg_bytes)
+    def accept(res):
+        enc, ext, hcode = res
+        if hcode:
+            dup = any(_hamming(hcode, prev)<=5 for prev in seen_hash)
+            stats.add("duplicate", dup, 0.0)
+            if dup: return
+            seen_hash.append(hcode)
+        if sink is None:
+            out.append(enc)
+        else:
+            ref = sink(enc, ext)
+            if ref: out.append(ref)
+
+    # i candidati arrivano con len(data) già prenotati in IMAGE_MEMORY (quota share): qui si integra fino alla stima
+    share = _MemoryShare(IMAGE_MEMORY)
+    candidates = _screen_gallery(gallery_urls, vendor, code, page_text, info, color_pref, ev, stats, plan, share)
+    pool = _image_pool()
+    if pool is None:
+        for url, data, w, h in candidates:
+            held = len(data)
+            try:
+                if len(out)>=want_n: break
+                with IMAGE_MEMORY.reserve(max(0, _estimate_image_mem(held, w, h) - held), share=share):
+                    try: res=_finalize_image(data, stats, plan)
+                    except Exception: res=None
+                    data=None
+                    if res: accept(res)
+            finally:
+                share.release(held)
+        return out
+
+    inflight=collections.deque()
+    def drain_one(use=True):
+        fut, shm, size, n = inflight.popleft()
+        res = None
+        try:
+            if use:
+                res, counts = _pool_result(fut, timeout=_deadline_remaining())
+                stats.merge(counts)
+            elif not fut.cancel(): fut.add_done_callback(_discard_pool_result)
+        except DeadlineExceeded:
+            fut.add_done_callback(_discard_pool_result); raise
         except Exception:
-            continue
+            res = None
+        finally:
+            shm.close(); shm.unlink(); IMAGE_MEMORY.release(n)
+        if use and res and len(out)<want_n: accept(res)
+
+    try:
+        for url, data, w, h in candidates:
+            held = len(data); n = 0
+            try:
+                if len(out)>=want_n: break
+                est = max(0, _estimate_image_mem(held, w, h) - held)
+                n = IMAGE_MEMORY.try_acquire(est)
+                while n is None and inflight:
+                    drain_one(); n = IMAGE_MEMORY.try_acquire(est)
+                if n is None: n = IMAGE_MEMORY.acquire(est, timeout=_deadline_remaining(), share=share)
+                if n is None: n = 0; _deadline_check(); raise DeadlineExceeded("memoria")
+                shm = _shm_from_bytes(data); size = len(data); data = None
+                inflight.append((pool.submit(_pool_finalize, shm.name, size), shm, size, n + held))
+                share.detach(held); held = n = 0
+            finally:
+                if held: share.release(held)
+                if n: IMAGE_MEMORY.release(n)
+            while len(inflight) >= IMAGE_WORKERS or (inflight and inflight[0][0].done()):
+                drain_one()
+                if len(out)>=want_n: break
+        while inflight:
+            drain_one(use=len(out)<want_n)
+    finally:
+        while inflight: drain_one(use=False)
     return out
 
 def _is_lifestyle_url_or_ctx(url, ctx_text_or_url):
-    u=(url or "").lower(); c=(ctx_text_or_url or "").lower()
-    if any(w in u for w in LIFESTYLE_HINT_WORDS): return True
-    if any(w in c for w in LIFESTYLE_HINT_WORDS): return True
-    return False
+    u=(url or "").lower()
+    if _LIFESTYLE_KW.any(u): return True
+    if isinstance(ctx_text_or_url, PageEvidence): return bool(ctx_text_or_url.lifestyle_hits)
+    return _LIFESTYLE_KW.any((ctx_text_or_url or "").lower())
 
 def _has_negative_keywords(url, ctx_text_or_url):
-    u=(url or "").lower(); c=(ctx_text_or_url or "").lower()
-    return any(k in u for k in NEGATIVE_KEYWORDS_IMG) or any(k in c for k in NEGATIVE_KEYWORDS_IMG)
+    u=(url or "").lower()
+    if _NEGATIVE_KW.any(u): return True
+    if isinstance(ctx_text_or_url, PageEvidence): return bool(ctx_text_or_url.negative_hits)
+    return _NEGATIVE_KW.any((ctx_text_or_url or "").lower())
 
 # === Shopify color extraction ===
 def extract_shopify_color(product_node: dict) -> str:
@@ -784,17 +2239,20 @@ def extract_shopify_color(product_node: dict) -> str:
     return ""
 
 # === Report ===
+REPORT_FIELDS = ["product_id","title","vendor","code","images_uploaded","description_updated","notes","context_url","image_urls",
+                 "stage_times","deadline_stage","filter_stats"]
+
 def row(pid, title, vendor, code, uploaded, desc_updated, notes, context_url="", image_urls=""):
     return {"product_id": pid, "title": title, "vendor": vendor, "code": code,
             "images_uploaded": uploaded, "description_updated": bool(desc_updated),
-            "notes": notes, "context_url": context_url, "image_urls": image_urls}
+            "notes": notes, "context_url": context_url, "image_urls": image_urls,
+            "stage_times": "", "deadline_stage": "", "filter_stats": ""}
 
 def report_and_exit(results, scanned, processed, skipped):
-    ts=datetime.now().strftime("%Y%m%d_%H%M%S")
-    csv_path=f"report_autofill_{ts}.csv"
+    csv_path=f"report_autofill_{RUN_TS}.csv"
     try:
         with open(csv_path,"w",newline="",encoding="utf-8") as f:
-            w=csv.DictWriter(f, fieldnames=["product_id","title","vendor","code","images_uploaded","description_updated","notes","context_url","image_urls"])
+            w=csv.DictWriter(f, fieldnames=REPORT_FIELDS)
             w.writeheader()
             for r in results: w.writerow(r)
         print(f"[REPORT] Salvato: {csv_path}")
@@ -806,6 +2264,7 @@ def report_and_exit(results, scanned, processed, skipped):
     except Exception as e:
         print(f"[REPORT ERROR] {e}")
     print(f"[SUMMARY] Scanned: {scanned} | Updated: {processed} | Skipped: {skipped}")
+    if FILTER_STATS.counts: print(f"[FILTRI] scartati/visti (tempo): {FILTER_STATS.summary()}")
 
 # === DESCRIZIONI (nuova struttura) ===
 def _clean_spaces(s: str) -> str:
@@ -889,9 +2348,10 @@ def gen_description_from_sources_magic_format(title, vendor, ptype, code, color_
     for q in queries:
         items=google_cse_web_search(q, num=8)
         for it in items:
+            _deadline_check()
             link=it.get("link"); d=domain(link)
             if not link: continue
-            if any(b in d for b in DOMAINS_BLACKLIST): continue
+            if classify_host(d).blacklisted: continue
             txt=_http_get_text(link, limit_bytes=CONTEXT_FETCH_MAX)
             if not txt: continue
             info=_extract_product_structured(txt)
@@ -910,7 +2370,176 @@ def gen_description_from_sources_magic_format(title, vendor, ptype, code, color_
     desc_html = build_magic_style_description(title, vendor, ptype, code, info, color_override=color_pref)
     return desc_html, None, 0.0
 
+# === Singolo prodotto ===
+def process_product(n, sku_terms=()):
+    dl = _Deadline(PRODUCT_DEADLINE_SEC, STAGE_DEADLINES)
+    fs = _FilterStats()
+    if _profile_selected(n): dl.profiler = _ProductProfiler()
+    _deadline_local.current = dl
+    _ProductProfiler.product_started()
+    try:
+        if dl.profiler: dl.profiler.start()
+        r = _process_product(n, sku_terms, dl, fs)
+    finally:
+        if dl.profiler: dl.profiler.stop()
+        _ProductProfiler.product_finished()
+        _deadline_local.current = None
+        FILTER_STATS.merge(fs.counts)
+    if dl.profiler:
+        try: print(f"  - Profilo salvato: {dl.profiler.dump(r.get('product_id') or 'unknown')}_* ({dl.profiler.coverage()})")
+        except Exception as e: print(f"  - ERRORE profilo: {e}")
+    r["stage_times"] = dl.summary(); r["deadline_stage"] = dl.exhausted_stage or ""
+    r["filter_stats"] = fs.summary()
+    if dl.exhausted_stage: print(f"  - Tempo esaurito nella fase '{dl.exhausted_stage}' ({r['stage_times']})")
+    return r
+
+def _process_product(n, sku_terms, dl, fs):
+    try:
+        pid=product_id_from_gid(n["id"])
+        title=safe_strip(n.get("title")); vendor=safe_strip(n.get("vendor"))
+        ptype=safe_strip(n.get("productType")); status=safe_strip(n.get("status")).lower()
+
+        has_img = len(safe_get(n,"images","edges",default=[]) or [])>0
+        has_desc = bool(safe_strip(n.get("bodyHtml")))
+
+        if status!="draft":
+            print(f"[PROCESS] {title} | brand={vendor or '-'} | SKIP: non DRAFT")
+            return row(pid,title,vendor,"",0,False,"skip: non draft")
+        if has_img or has_desc:
+            why=[]; 
+            if has_img: why.append("ha immagini")
+            if has_desc: why.append("ha descrizione")
+            print(f"[PROCESS] {title} | brand={vendor or '-'} | SKIP: {', '.join(why)}")
+            return row(pid,title,vendor,"",0,False,"skip: "+", ".join(why))
+
+        chosen_sku=""
+        for ve in (safe_get(n,"variants","edges",default=[]) or []):
+            s=safe_strip(safe_get(ve,"node","sku"))
+            if not s: continue
+            sl=s.lower(); sr=sku_root(sl)
+            if any(sl==t.lower() or sl.startswith(t.lower()) or sr==t.lower() for t in sku_terms):
+                chosen_sku=s; break
+        if not chosen_sku:
+            v_edges=safe_get(n,"variants","edges",default=[]) or []
+            if v_edges: chosen_sku=safe_strip(safe_get(v_edges[0],"node","sku"))
+
+        supplier = supplier_code_from_sku(chosen_sku) if chosen_sku else ""
+        supplier_root = sku_root(supplier) if supplier else ""
+        code_for_search = supplier_root or supplier
+        code_msg = code_for_search or "(no-code)"
+        print(f"[PROCESS] {title} | brand={vendor or '-'} | code={code_msg} (from SKU {chosen_sku or '-'})")
+
+        color_pref = extract_shopify_color(n)
+        if color_pref: print(f"  - Colore (Shopify): {color_pref}")
+
+        # ----- METAFIELD prompt per Shopify Magic
+        if WRITE_MAGIC_PROMPT_METAFIELD and chosen_sku:
+            prompt = magic_prompt_for_sku(chosen_sku)
+            if BATCH_SHOPIFY_WRITES:
+                SHOPIFY_WRITES.queue_metafield(pid, MAGIC_PROMPT_NAMESPACE, MAGIC_PROMPT_KEY, prompt)
+                print(f"  - Metafield prompt Magic accodato: {MAGIC_PROMPT_NAMESPACE}.{MAGIC_PROMPT_KEY}")
+            else:
+                try:
+                    create_or_update_metafield(pid, MAGIC_PROMPT_NAMESPACE, MAGIC_PROMPT_KEY, prompt)
+                    print(f"  - Metafield prompt Magic scritto: {MAGIC_PROMPT_NAMESPACE}.{MAGIC_PROMPT_KEY} ✅")
+                except Exception as ex:
+                    print(f"  - ERRORE metafield Magic: {ex}")
+
+        # ----- DESCRIZIONE
+        desc_updated=False; used_context_url=""; desc_conf=0.0
+        desc_html=""; ctx=None
+        if code_for_search:
+            with dl.stage("desc"):
+                desc_html, ctx, desc_conf = gen_description_from_sources_magic_format(title, vendor, ptype, code_for_search, color_pref=color_pref)
+        if desc_conf >= DESC_CONFIDENCE_THRESHOLD and desc_html:
+            if BATCH_SHOPIFY_WRITES:
+                SHOPIFY_WRITES.queue_description(pid, desc_html); desc_updated=True; print(f"  - Descrizione accodata (conf={desc_conf:.2f})")
+            else:
+                update_description(pid, desc_html); desc_updated=True; print(f"  - Descrizione aggiornata (conf={desc_conf:.2f}) ✅")
+            if ctx: used_context_url=ctx; print(f"    • Fonte: {ctx}")
+        else:
+            print(f"  - Descrizione NON aggiornata (conf={desc_conf:.2f} < {DESC_CONFIDENCE_THRESHOLD} o info minime assenti)")
+
+        # ----- IMMAGINI (GALLERY SINGLE-SOURCE)
+        uploaded=0; uploaded_refs=[]; gallery_source_url=None
+
+        if BING_IMAGE_KEY or (GOOGLE_CSE_KEY and GOOGLE_CSE_CX):
+            q_img=[]
+            if code_for_search:
+                if color_pref:
+                    q_img += [
+                        f"\"{code_for_search}\" \"{color_pref}\" packshot",
+                        f"{vendor} {code_for_search} \"{color_pref}\" studio",
+                        f"{title} {code_for_search} \"{color_pref}\" background",
+                    ]
+                q_img += [f"site:{d} {code_for_search} {color_pref}".strip() for d in (BRAND_DOMAINS_WHITELIST+TRUSTED_RETAILER_DOMAINS)]
+
+            best_ctx=None; best_info=None; best_text=None; best_ev=None
+            with dl.stage("search"):
+                candidates = collect_candidate_images(q_img, vendor=vendor, code=code_for_search)
+                fetch_ctx = lambda it: _http_get_text(it.get("context") or it["content"], limit_bytes=CONTEXT_FETCH_MAX)
+                for it, page_txt in _prefetch_ordered(candidates, fetch_ctx):
+                    dl.check()
+                    url=it["content"]; ctx=it.get("context") or url
+                    if not page_txt: continue
+                    info = _extract_product_structured(page_txt)
+                    ev = PageEvidence(page_txt, info, vendor, code_for_search, color_pref)
+                    conf = _img_confidence(vendor, code_for_search, url, ctx, page_txt, info, evidence=ev)
+                    d = domain(ctx or url)
+                    trusted = classify_host(d).trusted
+                    if conf>=IMG_CONFIDENCE_THRESHOLD and trusted:
+                        best_ctx=ctx; best_info=info; best_text=page_txt; best_ev=ev
+                        break
+
+            if best_ctx:
+                base_dom = domain(best_ctx)
+                alt_text=f"{vendor} {title}".strip()
+                def _upload(img_bytes, ext="jpg"):
+                    fn = f"{chosen_sku or pid}_{len(uploaded_refs)+1}.{ext}"
+                    try:
+                        img_id=add_image_attachment(pid, img_bytes, filename=fn, alt_text=alt_text)
+                    except Exception as ex:
+                        print(f"  - ERRORE immagine: {ex}"); return None
+                    uploaded_refs.append(fn)
+                    print(f"  - Immagine aggiunta (#{len(uploaded_refs)}) id={img_id} ✅ [attachment:{fn}]")
+                    return fn
+                with dl.stage("gallery"):
+                    gallery_urls, info_full, page_text = _collect_gallery_from_context(best_ctx, page_text=best_text)
+                    if info_full: best_info = info_full
+                    gallery_urls = [u for u in gallery_urls if domain(u)==base_dom]
+                    _process_gallery_to_attachments(
+                        gallery_urls, vendor, code_for_search, page_text, best_info, color_pref, want_n=MAX_IMAGES_PER_PRODUCT,
+                        evidence=best_ev, sink=_upload, stats=fs
+                    )
+                uploaded=len(uploaded_refs)
+                if uploaded>0:
+                    gallery_source_url = best_ctx
+                    print(f"  - Immagini caricate dalla stessa pagina: {base_dom} ✅")
+            elif not dl.exhausted_stage:
+                print("  - Nessuna pagina affidabile per galleria immagini trovata.")
+
+        if uploaded>0:
+            print(f"  Admin: {ADMIN_URL.format(pid=pid)}")
+
+        r = row(pid,title,vendor,code_for_search,uploaded,desc_updated,"",gallery_source_url or used_context_url," | ".join(uploaded_refs))
+        SHOPIFY_WRITES.commit_row(pid, r)
+        return r
+    except Exception as ex:
+        print(f"[ERROR prodotto] {ex}"); traceback.print_exc()
+        return row(pid if 'pid' in locals() else "", title if 'title' in locals() else "",
+                   vendor if 'vendor' in locals() else "", "", 0, False, f"errore prodotto: {ex}")
+
 # === MAIN ===
+def _selected_edges(sku_terms):
+    edges = fetch_products_by_variants_query_terms(sku_terms, kind="sku")
+    if not edges: edges = fallback_scan_draft_products_and_filter(sku_terms, limit_pages=6)
+
+    uniq={}; 
+    for e in edges:
+        n=e.get("node")
+        if n: uniq[n["id"]]=e
+    return list(uniq.values())
+
 def main():
     print(f"[START] draft_fashion_autofill {VERSION}")
     fonte="Google" if (GOOGLE_CSE_KEY and GOOGLE_CSE_CX) else ("Bing" if BING_IMAGE_KEY else "Nessuna")
@@ -925,14 +2554,7 @@ def main():
     sku_terms = expand_sku_terms_for_selection(ALLOWED_SKUS)
     if DEBUG: print(f"[DEBUG] SKU terms (expanded): {', '.join(sku_terms)}")
 
-    edges = fetch_products_by_variants_query_terms(sku_terms, kind="sku")
-    if not edges: edges = fallback_scan_draft_products_and_filter(sku_terms, limit_pages=6)
-
-    uniq={}; 
-    for e in edges:
-        n=e.get("node")
-        if n: uniq[n["id"]]=e
-    edges=list(uniq.values())
+    edges = _selected_edges(sku_terms)
 
     if not edges:
         print("[INFO] Nessun prodotto trovato (assicurati che gli SKU indicati siano presenti nelle varianti **in bozza**).")
@@ -942,134 +2564,418 @@ def main():
         if (processed+skipped)>=MAX_PRODUCTS: break
         n=e.get("node") or {}
         scanned+=1
-        try:
-            pid=product_id_from_gid(n["id"])
-            title=safe_strip(n.get("title")); vendor=safe_strip(n.get("vendor"))
-            ptype=safe_strip(n.get("productType")); status=safe_strip(n.get("status")).lower()
-
-            has_img = len(safe_get(n,"images","edges",default=[]) or [])>0
-            has_desc = bool(safe_strip(n.get("bodyHtml")))
-
-            if status!="draft":
-                skipped+=1; print(f"[PROCESS] {title} | brand={vendor or '-'} | SKIP: non DRAFT")
-                results.append(row(pid,title,vendor,"",0,False,"skip: non draft")); continue
-            if has_img or has_desc:
-                why=[]; 
-                if has_img: why.append("ha immagini")
-                if has_desc: why.append("ha descrizione")
-                skipped+=1; print(f"[PROCESS] {title} | brand={vendor or '-'} | SKIP: {', '.join(why)}")
-                results.append(row(pid,title,vendor,"",0,False,"skip: "+", ".join(why))); continue
-
-            chosen_sku=""
-            for ve in (safe_get(n,"variants","edges",default=[]) or []):
-                s=safe_strip(safe_get(ve,"node","sku"))
-                if not s: continue
-                sl=s.lower(); sr=sku_root(sl)
-                if any(sl==t.lower() or sl.startswith(t.lower()) or sr==t.lower() for t in sku_terms):
-                    chosen_sku=s; break
-            if not chosen_sku:
-                v_edges=safe_get(n,"variants","edges",default=[]) or []
-                if v_edges: chosen_sku=safe_strip(safe_get(v_edges[0],"node","sku"))
-
-            supplier = supplier_code_from_sku(chosen_sku) if chosen_sku else ""
-            supplier_root = sku_root(supplier) if supplier else ""
-            code_for_search = supplier_root or supplier
-            code_msg = code_for_search or "(no-code)"
-            print(f"[PROCESS] {title} | brand={vendor or '-'} | code={code_msg} (from SKU {chosen_sku or '-'})")
-
-            color_pref = extract_shopify_color(n)
-            if color_pref: print(f"  - Colore (Shopify): {color_pref}")
-
-            # ----- METAFIELD prompt per Shopify Magic
-            if WRITE_MAGIC_PROMPT_METAFIELD and chosen_sku:
-                prompt = magic_prompt_for_sku(chosen_sku)
-                try:
-                    create_or_update_metafield(pid, MAGIC_PROMPT_NAMESPACE, MAGIC_PROMPT_KEY, prompt)
-                    print(f"  - Metafield prompt Magic scritto: {MAGIC_PROMPT_NAMESPACE}.{MAGIC_PROMPT_KEY} ✅")
-                except Exception as ex:
-                    print(f"  - ERRORE metafield Magic: {ex}")
+        r=process_product(n, sku_terms); results.append(r)
+        if r["description_updated"] or r["images_uploaded"]: processed+=1
+        else: skipped+=1
+
+    SHOPIFY_WRITES.flush()
+    # i flush intermedi (commit_row) e quello finale possono aver annullato esiti: si ricontano dalle righe
+    processed = sum(1 for r in results if r["description_updated"] or r["images_uploaded"])
+    skipped = len(results) - processed
+    FILTER_STATS.save(FILTER_STATS_PATH)
+    report_and_exit(results, scanned, processed, skipped)
 
-            # ----- DESCRIZIONE
-            desc_updated=False; used_context_url=""; desc_conf=0.0
-            desc_html=""; ctx=None
-            if code_for_search:
-                desc_html, ctx, desc_conf = gen_description_from_sources_magic_format(title, vendor, ptype, code_for_search, color_pref=color_pref)
-            if desc_conf >= DESC_CONFIDENCE_THRESHOLD and desc_html:
-                update_description(pid, desc_html); desc_updated=True; print(f"  - Descrizione aggiornata (conf={desc_conf:.2f}) ✅")
-                if ctx: used_context_url=ctx; print(f"    • Fonte: {ctx}")
+# === DAEMON (webhook + coda locale) ===
+class _WorkQueue:
+    # un job per gid con lease; shared=True usa il journal classico (WAL vuole memoria condivisa locale)
+    def __init__(self, path, owner=None, shared=False):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.path = path; self.owner = owner or NODE_ID; self.shared = shared
+        self._local = threading.local()
+        self.wakeup = threading.Event()
+        with self._tx() as c:
+            c.execute("""CREATE TABLE IF NOT EXISTS jobs(
+                product_gid TEXT PRIMARY KEY, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+                source TEXT, enqueued_at REAL, updated_at REAL, last_error TEXT)""")
+            cols = {r[1] for r in c.execute("PRAGMA table_info(jobs)")}
+            for col, typ in (("lease_owner","TEXT"), ("lease_token","TEXT"), ("lease_expires","REAL")):
+                if col not in cols: c.execute(f"ALTER TABLE jobs ADD COLUMN {col} {typ}")
+            c.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, enqueued_at)")
+
+    def _conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = self._sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            c.execute("PRAGMA journal_mode=DELETE" if self.shared else "PRAGMA journal_mode=WAL")
+            self._local.conn = c
+        return c
+
+    def _tx(self):
+        conn = self._conn()
+        class _Tx:
+            def __enter__(s):
+                conn.execute("BEGIN IMMEDIATE"); return conn
+            def __exit__(s, et, ev, tb):
+                conn.execute("COMMIT" if et is None else "ROLLBACK"); return False
+        return _Tx()
+
+    def recover(self):
+        # solo job senza lease (versioni precedenti) o con lease scaduta: quelli vivi appartengono ad altri nodi
+        with self._tx() as c:
+            n = c.execute("""UPDATE jobs SET status='pending', lease_owner=NULL, lease_token=NULL, lease_expires=NULL, updated_at=?
+                             WHERE status='working' AND (lease_expires IS NULL OR lease_expires<?)""", (time.time(), time.time())).rowcount
+        if n: print(f"[QUEUE] Ripristinati {n} job interrotti")
+
+    def enqueue(self, gid, source="", reopen=True):
+        # reopen=False: seed idempotente da più nodi
+        now = time.time()
+        with self._tx() as c:
+            if reopen:
+                c.execute("""INSERT INTO jobs(product_gid,status,attempts,source,enqueued_at,updated_at) VALUES(?,'pending',0,?,?,?)
+                             ON CONFLICT(product_gid) DO UPDATE SET status='pending', attempts=0, source=excluded.source,
+                             enqueued_at=excluded.enqueued_at, updated_at=excluded.updated_at
+                             WHERE jobs.status IN ('done','failed')""", (gid, source, now, now))
             else:
-                print(f"  - Descrizione NON aggiornata (conf={desc_conf:.2f} < {DESC_CONFIDENCE_THRESHOLD} o info minime assenti)")
-
-            # ----- IMMAGINI (GALLERY SINGLE-SOURCE)
-            uploaded=0; uploaded_refs=[]; gallery_source_url=None
-
-            if BING_IMAGE_KEY or (GOOGLE_CSE_KEY and GOOGLE_CSE_CX):
-                q_img=[]
-                if code_for_search:
-                    if color_pref:
-                        q_img += [
-                            f"\"{code_for_search}\" \"{color_pref}\" packshot",
-                            f"{vendor} {code_for_search} \"{color_pref}\" studio",
-                            f"{title} {code_for_search} \"{color_pref}\" background",
-                        ]
-                    q_img += [f"site:{d} {code_for_search} {color_pref}".strip() for d in (BRAND_DOMAINS_WHITELIST+TRUSTED_RETAILER_DOMAINS)]
-                candidates = collect_candidate_images(q_img, vendor=vendor, code=code_for_search)
-
-                best_ctx=None; best_info=None; best_text=None
-                for it in candidates:
-                    url=it["content"]; ctx=it.get("context") or url
-                    page_txt = _http_get_text(ctx, limit_bytes=CONTEXT_FETCH_MAX)
-                    if not page_txt: continue
-                    info = _extract_product_structured(page_txt)
-                    conf = _img_confidence(vendor, code_for_search, url, ctx, page_txt, info)
-                    d = domain(ctx or url)
-                    trusted = (any(w in d for w in BRAND_DOMAINS_WHITELIST) or any(w in d for w in TRUSTED_RETAILER_DOMAINS))
-                    if conf>=IMG_CONFIDENCE_THRESHOLD and trusted:
-                        best_ctx=ctx; best_info=info; best_text=page_txt
-                        break
-
-                if best_ctx:
-                    gallery_urls, info_full, page_text = _collect_gallery_from_context(best_ctx, page_text=best_text)
-                    if info_full: best_info = info_full
-                    base_dom = domain(best_ctx)
-                    gallery_urls = [u for u in gallery_urls if domain(u)==base_dom]
-                    attachments = _process_gallery_to_attachments(
-                        gallery_urls, vendor, code_for_search, page_text, best_info, color_pref, want_n=MAX_IMAGES_PER_PRODUCT
-                    )
-                    idx=1
-                    for img_bytes in attachments:
-                        fn = f"{chosen_sku}_{idx}.jpg" if chosen_sku else f"{pid}_{idx}.jpg"
-                        try:
-                            img_id=add_image_attachment(pid, img_bytes, filename=fn, alt_text=f"{vendor} {title}".strip())
-                            uploaded+=1; idx+=1
-                            uploaded_refs.append(fn)
-                            print(f"  - Immagine aggiunta (#{uploaded}) id={img_id} ✅ [attachment:{fn}]")
-                        except Exception as ex:
-                            print(f"  - ERRORE immagine: {ex}")
-                    if uploaded>0:
-                        gallery_source_url = best_ctx
-                        print(f"  - Immagini caricate dalla stessa pagina: {base_dom} ✅")
-                else:
-                    print("  - Nessuna pagina affidabile per galleria immagini trovata.")
-
-            if uploaded>0:
-                print(f"  Admin: {ADMIN_URL.format(pid=pid)}")
+                c.execute("""INSERT OR IGNORE INTO jobs(product_gid,status,attempts,source,enqueued_at,updated_at)
+                             VALUES(?,'pending',0,?,?,?)""", (gid, source, now, now))
+        self.wakeup.set()
+
+    def _reclaim_expired(self, c, now):
+        c.execute("""UPDATE jobs SET status='failed', last_error='lease scaduta', lease_owner=NULL, lease_token=NULL,
+                     lease_expires=NULL, updated_at=? WHERE status='working' AND lease_expires<? AND attempts>=?""",
+                  (now, now, QUEUE_MAX_ATTEMPTS))
+        n = c.execute("""UPDATE jobs SET status='pending', lease_owner=NULL, lease_token=NULL, lease_expires=NULL, updated_at=?
+                         WHERE status='working' AND lease_expires<?""", (now, now)).rowcount
+        if n: print(f"[QUEUE] Recuperati {n} job con lease scaduta")
+
+    def claim(self):
+        with self._tx() as c:
+            now = time.time()
+            self._reclaim_expired(c, now)
+            r = c.execute("SELECT product_gid FROM jobs WHERE status='pending' ORDER BY enqueued_at LIMIT 1").fetchone()
+            if not r: return None
+            token = uuid.uuid4().hex
+            c.execute("""UPDATE jobs SET status='working', attempts=attempts+1, updated_at=?, lease_owner=?, lease_token=?,
+                         lease_expires=? WHERE product_gid=?""", (now, self.owner, token, now + SHARD_LEASE_SEC, r[0]))
+            return r[0], token
+
+    def heartbeat(self, gid, token):
+        # False se la lease è stata riassegnata
+        with self._tx() as c:
+            now = time.time()
+            return c.execute("""UPDATE jobs SET lease_expires=?, updated_at=? WHERE product_gid=? AND lease_token=?
+                                AND status='working' AND lease_expires>=?""", (now + SHARD_LEASE_SEC, now, gid, token, now)).rowcount > 0
+
+    def holds(self, gid, token):
+        r = self._conn().execute("""SELECT 1 FROM jobs WHERE product_gid=? AND lease_token=? AND status='working'
+                                    AND lease_expires>?""", (gid, token, time.time())).fetchone()
+        return r is not None
+
+    def complete(self, gid, error=None, token=None):
+        # con token solo se la lease è ancora nostra
+        fence = "" if token is None else " AND lease_token=?"
+        args = () if token is None else (token,)
+        with self._tx() as c:
+            now = time.time()
+            if error is None:
+                n = c.execute(f"""UPDATE jobs SET status='done', updated_at=?, last_error=NULL, lease_owner=NULL, lease_token=NULL,
+                                  lease_expires=NULL WHERE product_gid=?{fence}""", (now, gid) + args).rowcount
+            else:
+                n = c.execute(f"""UPDATE jobs SET status=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END,
+                                  enqueued_at=?, updated_at=?, last_error=?, lease_owner=NULL, lease_token=NULL, lease_expires=NULL
+                                  WHERE product_gid=?{fence}""", (QUEUE_MAX_ATTEMPTS, now, now, str(error)[:500], gid) + args).rowcount
+        if error is not None: self.wakeup.set()
+        return n > 0
+
+    def open_jobs(self):
+        return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending','working')").fetchone()[0]
+
+    def stats(self):
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+class LeaseLost(Exception):
+    pass
+
+class _Lease:
+    # heartbeat ogni SHARD_HEARTBEAT_SEC; le scritture Shopify verificano la lease (fencing)
+    def __init__(self, queue, gid, token):
+        self.queue = queue; self.gid = gid; self.token = token
+        self.lost = threading.Event(); self._stop = threading.Event(); self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._beat, name=f"lease-{self.gid.rsplit('/',1)[-1]}", daemon=True)
+        self._thread.start()
+        _lease_local.current = self
+        return self
+
+    def __exit__(self, et, ev, tb):
+        _lease_local.current = None
+        self._stop.set(); self._thread.join(timeout=5)
+        return False
 
-            results.append(row(pid,title,vendor,code_for_search,uploaded,desc_updated,"",gallery_source_url or used_context_url," | ".join(uploaded_refs)))
-            if desc_updated or uploaded>0: processed+=1
-            else: skipped+=1
+    def _beat(self):
+        while not self._stop.wait(SHARD_HEARTBEAT_SEC):
+            try:
+                if self.queue.heartbeat(self.gid, self.token): continue
+            except Exception as e:
+                print(f"[LEASE] Heartbeat fallito per {self.gid}: {e}"); continue   # ritenta: decide la scadenza
+            self.lost.set(); print(f"[LEASE] Lease persa per {self.gid}: il job è stato riassegnato")
+            return
+
+    def valid(self):
+        # solo una risposta negativa della tabella dà la lease per persa
+        if self.lost.is_set(): return False
+        for wait in (0.2, 0.5, 1.0, 2.0, None):
+            try:
+                ok = self.queue.holds(self.gid, self.token)
+            except Exception as e:
+                if wait is None:
+                    print(f"[LEASE] Verifica non riuscita per {self.gid}: {e}"); return False
+                time.sleep(wait); continue
+            if not ok: self.lost.set()
+            return ok
+
+    def check(self):
+        if not self.valid(): raise LeaseLost(self.gid)
+
+_lease_local = threading.local()
+
+def _current_lease():
+    return getattr(_lease_local, "current", None)
+
+def _lease_check():
+    lease = _current_lease()
+    if lease: lease.check()
+
+_daemon_report_lock = threading.Lock()
+
+def _append_daemon_report(r):
+    with _daemon_report_lock:
+        new = not os.path.isfile(DAEMON_REPORT_PATH)
+        with open(DAEMON_REPORT_PATH, "a", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=REPORT_FIELDS, extrasaction="ignore")
+            if new: w.writeheader()
+            w.writerow(r)
+
+def _prewarm_workers():
+    if ENFORCE_FACE_DETECTION and not _ensure_face_cascade():
+        print("[DAEMON] Cascade volti non disponibile")
+    if ENABLE_BG_REMOVAL:
+        try: _ensure_rembg_session()
+        except Exception as e: print(f"[DAEMON] rembg non disponibile: {e}")
+
+def _pool_ping():
+    return os.getpid()
+
+def _prewarm_http():
+    # per-thread: va chiamata nel thread che poi parla con Shopify (principale o worker daemon/shard)
+    with _warm_timer("http_pool"):
+        _http_session()
+        if HTTP_MODE != "replay" and STORE:
+            try: _http_request("HEAD", f"https://{STORE}/", timeout=5, deadline=False, allow_redirects=False)
+            except Exception: pass
+
+def prewarm():
+    # --prewarm: cascade, rembg e process pool in parallelo al pool HTTP; restituisce i secondi
+    from concurrent.futures import ThreadPoolExecutor
+    t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        jobs = []
+        if ENFORCE_FACE_DETECTION: jobs.append(("cascade", ex.submit(_ensure_face_cascade)))
+        if ENABLE_BG_REMOVAL: jobs.append(("rembg", ex.submit(_ensure_rembg_session)))
+        pool = _image_pool()
+        if pool is not None:
+            jobs.append(("image_pool", ex.submit(lambda: [f.result() for f in [pool.submit(_pool_ping) for _ in range(IMAGE_WORKERS)]])))
+        _prewarm_http()
+        for name, fut in jobs:
+            try:
+                if fut.result() is False: print(f"[PREWARM] {name} non disponibile")
+            except Exception as e:
+                print(f"[PREWARM] {name} non disponibile: {e}")
+    sec = time.perf_counter() - t
+    print(f"[PREWARM] Pronto in {sec:.1f}s")
+    return sec
+
+def _print_timings(import_sec, prewarm_sec, run_sec, lazy_sec):
+    # i caricamenti pigri durante il run contano nel warm-up
+    with _warmup_lock: parts = " ".join(f"{k}={v:.2f}s" for k, v in sorted(_WARMUP_TIMES.items()))
+    print(f"[TEMPI] import: {import_sec:.2f}s | warm-up: {prewarm_sec+lazy_sec:.2f}s ({parts or '-'}) | "
+          f"elaborazione: {max(0.0, run_sec-lazy_sec):.2f}s")
+
+def _is_loopback(host):
+    import ipaddress
+    if host == "localhost": return True
+    try: return ipaddress.ip_address(host).is_loopback
+    except ValueError: return False
+
+def _unsigned_webhooks_allowed():
+    return ALLOW_UNSIGNED_WEBHOOKS and _is_loopback(SERVE_HOST)
+
+def _webhook_hmac_ok(body, header_val):
+    if not SHOPIFY_WEBHOOK_SECRET: return _unsigned_webhooks_allowed()
+    import hmac
+    digest = base64.b64encode(hmac.new(SHOPIFY_WEBHOOK_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    return bool(header_val) and hmac.compare_digest(digest, header_val)
+
+def _gids_from_payload(path, payload):
+    # products/create|update (solo bozze) oppure /enqueue: {"id"|"ids"|"sku"|"skus"}
+    if path.startswith("/webhooks"):
+        if safe_strip(payload.get("status")).lower() not in ("", "draft"): return []
+        gid = payload.get("admin_graphql_api_id") or (f"gid://shopify/Product/{payload['id']}" if payload.get("id") else "")
+        return [gid] if gid else []
+    ids = payload.get("ids") or ([payload["id"]] if payload.get("id") else [])
+    gids = [i if str(i).startswith("gid://") else f"gid://shopify/Product/{i}" for i in ids]
+    skus = payload.get("skus") or ([payload["sku"]] if payload.get("sku") else [])
+    if skus:
+        gids += [e["node"]["id"] for e in fetch_products_by_variants_query_terms(expand_sku_terms_for_selection(skus), kind="sku")]
+    return gids
+
+def _make_webhook_handler(queue):
+    from http.server import BaseHTTPRequestHandler
+    class _WebhookHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code); self.send_header("Content-Type","application/json")
+            self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health": return self._reply(200, {"ok": True, "queue": queue.stats()})
+            self._reply(404, {"ok": False})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            path = self.path.split("?",1)[0]
+            if path not in ("/webhooks/products/create", "/webhooks/products/update", "/webhooks/shopify", "/enqueue"):
+                return self._reply(404, {"ok": False})
+            local_enqueue = path == "/enqueue" and _is_loopback(self.client_address[0])
+            if not local_enqueue and not _webhook_hmac_ok(body, self.headers.get("X-Shopify-Hmac-Sha256")):
+                return self._reply(401, {"ok": False, "error": "hmac"})
+            try:
+                payload = json.loads(body.decode("utf-8") or "{}")
+                gids = _gids_from_payload(path, payload)
+            except Exception as ex:
+                return self._reply(400, {"ok": False, "error": str(ex)})
+            src = self.headers.get("X-Shopify-Topic") or path
+            for gid in gids: queue.enqueue(gid, source=src)
+            self._reply(200, {"ok": True, "enqueued": gids})
+
+        def log_message(self, fmt, *args):
+            if DEBUG: print("[HTTPD] " + (fmt % args))
+    return _WebhookHandler
+
+def _complete_job(queue, gid, error=None, token=None):
+    # 'database is locked' sul file condiviso è transitorio: si ritenta, poi decide la scadenza della lease
+    for wait in (0.2, 0.5, 1.0, 2.0, None):
+        try: return queue.complete(gid, error=error, token=token)
+        except Exception as e:
+            if wait is None: print(f"[QUEUE] Chiusura job {gid} non riuscita: {e}"); return False
+            time.sleep(wait)
 
-        except Exception as ex:
-            skipped+=1
-            print(f"[ERROR prodotto] {ex}"); traceback.print_exc()
-            results.append(row(pid if 'pid' in locals() else "", title if 'title' in locals() else "",
-                               vendor if 'vendor' in locals() else "", "", 0, False, f"errore prodotto: {ex}"))
+def _run_job(queue, gid, token, sku_terms=()):
+    # None se prodotto assente o lease persa
+    try:
+        with _Lease(queue, gid, token) as lease:
+            n = fetch_product_by_gid(gid)
+            if not n:
+                _complete_job(queue, gid, error="prodotto non trovato", token=token); return None
+            r = process_product(n, sku_terms)
+            SHOPIFY_WRITES.flush(pids=[product_id_from_gid(gid)])   # solo le scritture di questo job/lease
+            if lease.lost.is_set():
+                print(f"[QUEUE] {gid}: lease persa durante l'elaborazione, esito scartato"); return None
+        FILTER_STATS.save(FILTER_STATS_PATH)
+        err = r["notes"] if str(r.get("notes","")).startswith("errore prodotto") else None
+        _complete_job(queue, gid, error=err, token=token)
+        return r
+    except Exception as ex:
+        print(f"[QUEUE] Errore job {gid}: {ex}"); traceback.print_exc()
+        _complete_job(queue, gid, error=ex, token=token)
+        return None
 
-    report_and_exit(results, scanned, processed, skipped)
+def _daemon_worker(queue, stop):
+    _prewarm_http()
+    while not stop.is_set():
+        try:
+            job = queue.claim()
+            if not job:
+                queue.wakeup.wait(2.0); queue.wakeup.clear(); continue
+            r = _run_job(queue, *job)
+            if r: _append_daemon_report(r)
+        except Exception as e:   # es. coda bloccata: il worker non deve morire
+            print(f"[QUEUE] Errore worker: {e}"); stop.wait(2.0)
+
+def serve():
+    from http.server import ThreadingHTTPServer
+    print(f"[START] draft_fashion_autofill {VERSION} (daemon)")
+    if not SHOPIFY_WEBHOOK_SECRET:
+        if not _unsigned_webhooks_allowed():
+            print("[DAEMON] SHOPIFY_WEBHOOK_SECRET mancante: avvio rifiutato (webhook non autenticati). "
+                  "Solo per test: SERVE_HOST loopback + ALLOW_UNSIGNED_WEBHOOKS=true")
+            return
+        print("[DAEMON] ATTENZIONE: webhook senza firma HMAC accettati (ALLOW_UNSIGNED_WEBHOOKS, solo loopback)")
+    queue = _WorkQueue(QUEUE_DB_PATH); queue.recover()
+    prewarm()
+    stop = threading.Event()
+    workers = [threading.Thread(target=_daemon_worker, args=(queue, stop), name=f"autofill-worker-{i}", daemon=True)
+               for i in range(DAEMON_WORKERS)]
+    for t in workers: t.start()
+    httpd = ThreadingHTTPServer((SERVE_HOST, SERVE_PORT), _make_webhook_handler(queue))
+    print(f"[DAEMON] In ascolto su http://{SERVE_HOST}:{SERVE_PORT} | worker: {DAEMON_WORKERS} | coda: {QUEUE_DB_PATH}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("[DAEMON] Arresto richiesto")
+    finally:
+        stop.set(); queue.wakeup.set(); httpd.server_close()
+        for t in workers: t.join(timeout=30)
+        SHOPIFY_WRITES.flush()
+
+# === SHARD (più nodi sulla stessa tabella di lavoro) ===
+def shard():
+    # --shard: selezione in SHARD_DB_PATH (idempotente), poi job in lease finché ce ne sono di aperti
+    print(f"[START] draft_fashion_autofill {VERSION} (shard {NODE_ID})")
+    if not SHARD_DB_PATH:
+        print("[SHARD] ERRORE: SHARD_DB_PATH non impostato. Serve una tabella di lavoro condivisa tra i nodi "
+              "(una coda locale non coordina nulla e i prodotti verrebbero elaborati più volte).")
+        return
+    if os.path.abspath(SHARD_DB_PATH) == os.path.abspath(QUEUE_DB_PATH):
+        print(f"[SHARD] ATTENZIONE: SHARD_DB_PATH coincide con la coda locale del daemon ({QUEUE_DB_PATH}): "
+              "verifica che sia su storage condiviso tra i nodi")
+    queue = _WorkQueue(SHARD_DB_PATH, shared=True); queue.recover()
+    sku_terms = expand_sku_terms_for_selection(ALLOWED_SKUS) if ALLOWED_SKUS else []
+    if sku_terms:
+        edges = _selected_edges(sku_terms)[:MAX_PRODUCTS]
+        for e in edges: queue.enqueue(e["node"]["id"], source=f"shard:{NODE_ID}", reopen=False)
+        print(f"[SHARD] Selezione: {len(edges)} prodotti | coda: {queue.stats()}")
+
+    results=[]; lock=threading.Lock()
+    def worker():
+        _prewarm_http()
+        while True:
+            try:
+                job = queue.claim()
+                if job:
+                    r = _run_job(queue, *job, sku_terms=sku_terms)
+                    if r:
+                        with lock: results.append(r)
+                    continue
+                if not queue.open_jobs(): return
+            except Exception as e:   # es. 'database is locked' sulla tabella condivisa: si riprova
+                print(f"[SHARD] Errore worker: {e}")
+            # job in lavorazione su altri nodi: si attende, una lease scaduta torna disponibile
+            time.sleep(min(5.0, max(0.5, SHARD_HEARTBEAT_SEC/4)))
+    threads = [threading.Thread(target=worker, name=f"shard-worker-{i}", daemon=True) for i in range(DAEMON_WORKERS)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    SHOPIFY_WRITES.flush()
+
+    processed = sum(1 for r in results if r["description_updated"] or r["images_uploaded"])
+    skipped = len(results) - processed
+    print(f"[SHARD] Coda: {queue.stats()}")
+    FILTER_STATS.save(FILTER_STATS_PATH)
+    report_and_exit(results, len(results), processed, skipped)
 
 if __name__ == "__main__":
     try:
+        import_sec = time.perf_counter() - _T0
         print(f"[INFO] Using store: {STORE}")
-        main(); sys.exit(0)
+        args = sys.argv[1:]
+        if "--serve" in args: serve()
+        else:
+            prewarm_sec = prewarm() if "--prewarm" in args else 0.0
+            lazy0 = _warmup_total(); t = time.perf_counter()
+            shard() if "--shard" in args else main()
+            _print_timings(import_sec, prewarm_sec, time.perf_counter()-t, _warmup_total()-lazy0)
+        sys.exit(0)
     except Exception as e:
         print("=== UNCAUGHT ERROR ==="); print(repr(e)); traceback.print_exc(); sys.exit(0)
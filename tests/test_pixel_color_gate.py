@@ -0,0 +1,37 @@
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+
+import draft_fashion_autofill as m
+
+
+def garment(bg, fg, print_rgb=None):
+    im = Image.new("RGB", (1200, 1400), bg); d = ImageDraw.Draw(im)
+    d.rectangle((300, 250, 900, 1200), fill=fg)
+    if print_rgb: d.rectangle((450, 450, 750, 800), fill=print_rgb)
+    b = BytesIO(); im.save(b, "JPEG", quality=90); return b.getvalue()
+
+
+@pytest.mark.parametrize("bg, fg, print_rgb, color, expect", [
+    ((255,255,255), (246,246,246), (25,32,72), "Bianco", True),   # bianco su bianco con stampa
+    ((225,225,225), (248,248,248), (25,32,72), "bianco", True),
+    ((18,18,18), (24,24,24), None, "Nero", True),                 # nero su nero
+    ((255,255,255), (190,30,40), None, "Rosso", True),
+    ((255,255,255), (20,20,20), None, "Rosso", False),
+    ((255,255,255), (25,32,72), None, "Blu", True),
+])
+def test_pixel_color_match(bg, fg, print_rgb, color, expect):
+    assert m._pixel_color_match(garment(bg, fg, print_rgb), color) is expect
+
+
+def test_unknown_color_passes():
+    assert m._pixel_color_match(garment((255,255,255), (20,20,20)), "Fantasia") is True
+
+
+def test_foreground_decodes_jpeg_in_draft():
+    fg, bg = m._foreground_lab(garment((255,255,255), (190,30,40)))
+    assert len(fg) and len(fg) <= m.PIXEL_PROXY_SIDE * m.PIXEL_PROXY_SIDE